@@ -220,7 +220,7 @@ class Block(Record):
 
     @property
     def space_info(self):
-        return self._client.post("getPublicPageData", {"blockId": self.id}).json()
+        return self._client.call_api("getPublicPageData", {"blockId": self.id})
 
     def _str_fields(self):
         """
@@ -546,7 +546,7 @@ class PageBlock(BasicBlock):
         """
         Returns a list of blocks that referencing the current PageBlock. Note that only PageBlocks support backlinks.
         """
-        data = self._client.post("getBacklinksForBlock", {"blockId": self.id}).json()
+        data = self._client.call_api("getBacklinksForBlock", {"blockId": self.id})
         backlinks = []
         for block in data.get("backlinks") or []:
             mention = block.get("mentioned_from")
@@ -638,16 +638,19 @@ class EmbedOrUploadBlock(EmbedBlock):
         mimetype = mimetypes.guess_type(path)[0] or "text/plain"
         filename = os.path.split(path)[-1]
 
-        data = self._client.post(
+        data = self._client.call_api(
             "getUploadFileUrl",
             {"bucket": "secure", "name": filename, "contentType": mimetype},
-        ).json()
+        )
 
-        with open(path, "rb") as f:
-            response = requests.put(
-                data["signedPutUrl"], data=f, headers={"Content-type": mimetype}
-            )
-            response.raise_for_status()
+        def put_file():
+            with open(path, "rb") as f:
+                return requests.put(
+                    data["signedPutUrl"], data=f, headers={"Content-type": mimetype}
+                )
+
+        response = self._client._rate_limiter.request("upload", put_file)
+        response.raise_for_status()
 
         self.display_source = data["url"]
         self.source = data["url"]
@@ -1,12 +1,26 @@
 import hashlib
+import io
 import json
+import os
 import re
+import ssl
+import threading
+import time
 import uuid
 
-from requests import Session, HTTPError
-from requests.cookies import cookiejar_from_dict
+from collections import defaultdict
+from email.message import Message
+from requests import Session, HTTPError, Response
+from requests.cookies import cookiejar_from_dict, extract_cookies_to_jar
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+from requests.structures import CaseInsensitiveDict
+from requests.utils import (
+    DEFAULT_CA_BUNDLE_PATH,
+    get_encoding_from_headers,
+    get_environ_proxies,
+)
 from urllib.parse import urljoin
-from requests.adapters import HTTPAdapter
+from requests.adapters import BaseAdapter, HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from getpass import getpass
 
@@ -18,9 +32,12 @@ from .collection import (
     COLLECTION_VIEW_TYPES,
     TemplateBlock,
 )
+from .jsoncodec import get_json_codec
+from .jsonstream import RecordMapStream
 from .logger import logger
 from .monitor import Monitor
 from .operations import operation_update_last_edited, build_operation
+from .ratelimit import RateLimiter
 from .settings import API_BASE_URL
 from .space import Space
 from .store import RecordStore
@@ -28,9 +45,236 @@ from .user import User
 from .utils import extract_id, now
 
 
-def create_session(client_specified_retry=None):
+# size of the chunks in which streamed responses are read and decoded
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# default (connect, read) timeouts, in seconds; the read timeout needs to comfortably exceed the
+# long-polling interval used by the Monitor, which holds requests open for ~25 seconds
+DEFAULT_TIMEOUT = (10, 60)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that applies a default timeout to any request that doesn't explicitly specify one,
+    so that a hung connection can't block the calling thread forever.
+    """
+
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+class HTTP2Adapter(BaseAdapter):
+    """
+    A transport adapter that sends requests over HTTP/2 using `httpx` (install with `pip install httpx[http2]`),
+    while still returning standard `requests.Response` objects to the rest of the client (including streamed
+    responses, and cookies set by the server, which are passed back to the session as usual).
+
+    Failed connection attempts are retried up to `connect_retries` times (nothing has been sent at that point,
+    so this is safe even for submitTransaction), but unlike with the default adapter, there's no urllib3 retry
+    policy, so requests aren't retried on 502/503/504 responses. The `verify` and `cert` settings of each request
+    are honoured, but proxies are only supported via the standard environment variables (which httpx reads
+    itself); passing any others raises a ValueError.
+    """
+
+    def __init__(
+        self, timeout=DEFAULT_TIMEOUT, pool_maxsize=10, pool_connections=10, connect_retries=3
+    ):
+        super().__init__()
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError(
+                "HTTP/2 support requires the 'httpx' package: pip install httpx[http2]"
+            )
+        self.timeout = timeout
+        self.connect_retries = connect_retries
+        self._limits = httpx.Limits(
+            max_connections=pool_maxsize, max_keepalive_connections=pool_connections
+        )
+        # httpx only takes TLS settings per client, so we keep one for each combination that's been requested
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def _get_client(self, verify, cert):
+        import httpx
+
+        key = (verify, cert)
+        with self._clients_lock:
+            if key not in self._clients:
+                verify = _build_ssl_context(verify, cert)
+                self._clients[key] = httpx.Client(
+                    http2=True,
+                    verify=verify,
+                    limits=self._limits,
+                    transport=httpx.HTTPTransport(
+                        http2=True,
+                        verify=verify,
+                        limits=self._limits,
+                        retries=self.connect_retries,
+                    ),
+                )
+            return self._clients[key]
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        import httpx
+
+        # requests adds any proxies from the environment to those passed in; httpx picks those up by itself
+        environ_proxies = get_environ_proxies(request.url)
+        unsupported = [
+            scheme
+            for scheme, url in (proxies or {}).items()
+            if url and url != environ_proxies.get(scheme)
+        ]
+        if unsupported:
+            raise ValueError(
+                "HTTP2Adapter doesn't support proxies other than those set in the environment (got {})".format(
+                    ", ".join(unsupported)
+                )
+            )
+
+        timeout = timeout if timeout is not None else self.timeout
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        else:
+            timeout = httpx.Timeout(timeout)
+
+        # build the request ourselves rather than through the httpx client, so that cookies are managed only by
+        # the requests session (which has already added them to the headers)
+        httpx_request = httpx.Request(
+            request.method,
+            request.url,
+            headers=dict(request.headers),
+            content=request.body,
+            extensions={"timeout": timeout.as_dict()},
+        )
+
+        try:
+            httpx_response = self._get_client(verify, cert).send(
+                httpx_request, stream=stream
+            )
+        except httpx.TimeoutException as e:
+            raise Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise RequestsConnectionError(e, request=request)
+
+        response = Response()
+        response.status_code = httpx_response.status_code
+        response.reason = httpx_response.reason_phrase
+        response.headers = CaseInsensitiveDict(httpx_response.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.raw = _HTTPXRawResponse(httpx_response, request)
+        if not stream:
+            response._content = response.raw.read()
+        extract_cookies_to_jar(response.cookies, request, response.raw)
+        return response
+
+    def close(self):
+        with self._clients_lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+
+class _HTTPXRawResponse(io.RawIOBase):
+    """
+    A file-like wrapper around an `httpx` response body, standing in for the urllib3 response that
+    `requests.Response.raw` would normally be, so that `iter_content` and cookie extraction work as usual.
+    """
+
+    def __init__(self, httpx_response, request):
+        super().__init__()
+        self._httpx_response = httpx_response
+        self._request = request
+        self._chunks = httpx_response.iter_bytes()
+        self._buffer = b""
+        # requests reads the Set-Cookie headers from here
+        msg = Message()
+        for name, value in httpx_response.headers.multi_items():
+            msg[name] = value
+        self._original_response = _OriginalResponse(msg)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        import httpx
+
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+            except httpx.TimeoutException as e:
+                raise Timeout(e, request=self._request)
+            except httpx.TransportError as e:
+                raise RequestsConnectionError(e, request=self._request)
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        self._httpx_response.close()
+        super().close()
+
+
+class _OriginalResponse(object):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def _build_ssl_context(verify, cert):
+    """
+    Turn requests-style `verify` and `cert` arguments into something httpx accepts as its `verify` setting.
+    """
+    if cert is None and isinstance(verify, bool):
+        return verify
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif verify is True:
+        context = ssl.create_default_context(cafile=DEFAULT_CA_BUNDLE_PATH)
+    elif os.path.isdir(verify):
+        context = ssl.create_default_context(capath=verify)
+    else:
+        context = ssl.create_default_context(cafile=verify)
+    if cert:
+        if isinstance(cert, str):
+            context.load_cert_chain(cert)
+        else:
+            context.load_cert_chain(*cert)
+    return context
+
+
+def create_session(
+    client_specified_retry=None,
+    pool_connections=10,
+    pool_maxsize=10,
+    pool_block=False,
+    timeout=DEFAULT_TIMEOUT,
+    compression=True,
+    http2=False,
+):
     """
     retry on 502
+
+    `pool_connections` is the number of distinct hosts to keep connection pools for, and `pool_maxsize` is the
+    number of keep-alive connections held open per host (raise it when sharing one client across many threads;
+    set `pool_block` to make threads wait for a free connection rather than opening throwaway ones). `timeout`
+    is a (connect, read) tuple or a single number of seconds, applied to every request that doesn't set its own.
+
+    With `http2`, requests go through `HTTP2Adapter`, which only retries failed connection attempts: the retry
+    policy above (including `client_specified_retry`) doesn't apply, so 502/503/504 responses aren't retried.
     """
     session = Session()
     if client_specified_retry:
@@ -51,8 +295,35 @@ def create_session(client_specified_retry=None):
                 "DELETE",
             ),
         )
-    adapter = HTTPAdapter(max_retries=retry)
+    if http2:
+        # this retries failed connection attempts on every endpoint, which is also safe for submitTransaction
+        adapter = HTTP2Adapter(
+            timeout=timeout, pool_maxsize=pool_maxsize, pool_connections=pool_connections
+        )
+    else:
+        adapter = TimeoutHTTPAdapter(
+            max_retries=retry,
+            timeout=timeout,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
     session.mount("https://", adapter)
+    if not http2:
+        # submitTransaction isn't idempotent, so only retry it at the HTTP level when we failed to connect
+        # (i.e. nothing was sent); other failures are handled by `NotionClient._post_transaction`
+        session.mount(
+            urljoin(API_BASE_URL, "submitTransaction"),
+            TimeoutHTTPAdapter(
+                max_retries=Retry(3, connect=3, read=0, status=0, backoff_factor=0.3),
+                timeout=timeout,
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block,
+            ),
+        )
+    if not compression:
+        session.headers["Accept-Encoding"] = "identity"
     return session
 
 
@@ -61,6 +332,9 @@ class NotionClient(object):
     This is the entry point to using the API. Create an instance of this class, passing it the value of the
     "token_v2" cookie from a logged-in browser session on Notion.so. Most of the methods on here are primarily
     for internal use -- the main one you'll likely want to use is `get_block`.
+
+    Pass `http2=True` to send requests over HTTP/2 (requires `httpx`); note that in that case requests are only
+    retried when connecting fails, and not on 502/503/504 responses (see `create_session`).
     """
 
     def __init__(
@@ -68,13 +342,46 @@ class NotionClient(object):
         token_v2=None,
         monitor=False,
         start_monitoring=False,
+        monitor_transport="polling",
+        monitor_debounce=0,
+        monitor_max_subscriptions_per_session=5000,
         enable_caching=False,
         cache_key=None,
         email=None,
         password=None,
         client_specified_retry=None,
+        pool_connections=10,
+        pool_maxsize=10,
+        pool_block=False,
+        timeout=DEFAULT_TIMEOUT,
+        compression=True,
+        http2=False,
+        rate_limit=None,
+        rate_limit_burst=None,
+        endpoint_rate_limits=None,
+        rate_limit_retries=5,
+        transaction_retries=3,
+        json_codec=None,
+        callback_workers=4,
+        callback_queue_size=1000,
     ):
-        self.session = create_session(client_specified_retry)
+        self.json_codec = get_json_codec(json_codec)
+        self.session = create_session(
+            client_specified_retry,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            timeout=timeout,
+            compression=compression,
+            http2=http2,
+        )
+        self._rate_limiter = RateLimiter(
+            rate=rate_limit,
+            burst=rate_limit_burst,
+            endpoint_rates=endpoint_rate_limits,
+            max_retries=rate_limit_retries,
+        )
+        self.transaction_retries = transaction_retries
         if token_v2:
             self.session.cookies = cookiejar_from_dict({"token_v2": token_v2})
         else:
@@ -82,11 +389,21 @@ class NotionClient(object):
 
         if enable_caching:
             cache_key = cache_key or hashlib.sha256(token_v2.encode()).hexdigest()
-            self._store = RecordStore(self, cache_key=cache_key)
         else:
-            self._store = RecordStore(self)
+            cache_key = None
+        self._store = RecordStore(
+            self,
+            cache_key=cache_key,
+            callback_workers=callback_workers,
+            callback_queue_size=callback_queue_size,
+        )
         if monitor:
-            self._monitor = Monitor(self)
+            self._monitor = Monitor(
+                self,
+                transport=monitor_transport,
+                debounce=monitor_debounce,
+                max_subscriptions_per_session=monitor_max_subscriptions_per_session,
+            )
             if start_monitoring:
                 self.start_monitoring()
         else:
@@ -96,6 +413,19 @@ class NotionClient(object):
 
     def start_monitoring(self):
         self._monitor.poll_async()
+
+    def watch(self, records, recursive=False):
+        """
+        Subscribe to live updates from the server for a record, or a list of records (does nothing if the client
+        was created without `monitor=True`). Records aren't watched just by being instantiated, so this is how to
+        opt in. If `recursive` is True, the descendants of each record that are in the local store (child blocks,
+        and the rows of collections) are watched too. All the subscriptions are registered in batched requests.
+        """
+        if self._monitor is None:
+            return
+        if not isinstance(records, (list, tuple, set)):
+            records = [records]
+        self._monitor.subscribe(list(records), recursive=recursive)
     
     def _fetch_guest_space_data(self, records):
         """
@@ -106,9 +436,9 @@ class NotionClient(object):
         """
         space_id = list(records["space_view"].values())[0]["value"]["space_id"]
 
-        space_data = self.post(
+        space_data = self.call_api(
             "getPublicSpaceData", {"type": "space-ids", "spaceIds": [space_id]}
-        ).json()
+        )
 
         records["space"] = {
             space["id"]: {"value": space} for space in space_data["results"]
@@ -120,10 +450,10 @@ class NotionClient(object):
             email = input("Enter your Notion email address:\n")
         if not password:
             password = getpass("Enter your Notion password:\n")
-        self.post("loginWithEmail", {"email": email, "password": password}).json()
+        self.call_api("loginWithEmail", {"email": email, "password": password})
 
     def _update_user_info(self):
-        records = self.post("loadUserContent", {}).json()["recordMap"]
+        records = self.call_api("loadUserContent", {})["recordMap"]
         if not records["space"]:
             self._fetch_guest_space_data(records)
 
@@ -133,7 +463,7 @@ class NotionClient(object):
         return records
 
     def get_email_uid(self):
-        response = self.post("getSpaces", {}).json()
+        response = self.call_api("getSpaces", {})
         return {
             response[uid]["notion_user"][uid]["value"]["email"]: uid
             for uid in response.keys()
@@ -234,6 +564,14 @@ class NotionClient(object):
             else None
         )
 
+    def change_feed(self, maxsize=10000, tables=None, block=True):
+        """
+        Return a ChangeFeed: an iterator (sync or async) over `(table, id, version, difference)` events for every
+        subsequent change to a record in the local store, for consumers that want to process changes in batches
+        rather than registering callbacks on individual records. See `ChangeFeed` for details.
+        """
+        return self._store.change_feed(maxsize=maxsize, tables=tables, block=block)
+
     def refresh_records(self, **kwargs):
         """
         The keyword arguments map table names into lists of (or singular) record IDs to load for that table.
@@ -242,15 +580,44 @@ class NotionClient(object):
         self._store.call_get_record_values(**kwargs)
 
     def refresh_collection_rows(self, collection_id):
-        row_ids = [row.id for row in self.get_collection(collection_id).get_rows()]
+        """
+        Update the local list of a collection's row IDs. We first ask only for the number of rows (which doesn't
+        return any of them), and only re-fetch the rows if that differs from the number we know of, so that e.g.
+        an edit to an existing row doesn't cost a download of the whole collection. Use `Collection.load_rows`
+        to unconditionally load all the rows.
+
+        A matching count doesn't prove the list is right (a row may have been added and another removed), so
+        in that case the list is left as it is, without being marked as freshly loaded; local queries still
+        treat it as stale once it's older than their `max_age`.
+        """
+        collection = self.get_collection(collection_id)
+        known_ids = [
+            id
+            for id in self._store.get_collection_rows(collection_id)
+            if (self._store._get("block", id) or {}).get("alive", True)
+        ]
+        total = collection.get_rows(limit=0).total
+        if known_ids and total == len(known_ids):
+            return
+        row_ids = collection.get_rows(limit=total)._block_ids
         self._store.set_collection_rows(collection_id, row_ids)
 
-    def post(self, endpoint, data):
+    def post(self, endpoint, data, stream=False):
         """
         All API requests on Notion.so are done as POSTs (except the websocket communications).
+        Requests are throttled by the client's rate limiter, and retried when the server responds with a 429.
+        If `stream` is True, the response body is not downloaded until it is read (e.g. via `iter_content`).
         """
         url = urljoin(API_BASE_URL, endpoint)
-        response = self.session.post(url, json=data)
+        response = self._rate_limiter.request(
+            endpoint,
+            lambda: self.session.post(
+                url,
+                data=self.json_codec.dumpb(data),
+                headers={"Content-Type": "application/json"},
+                stream=stream,
+            ),
+        )
         if response.status_code == 400:
             logger.error(
                 "Got 400 error attempting to POST to {}, with data: {}".format(
@@ -258,13 +625,34 @@ class NotionClient(object):
                 )
             )
             raise HTTPError(
-                response.json().get(
+                self.json_codec.loads(response.content).get(
                     "message", "There was an error (400) submitting the request."
                 )
             )
         response.raise_for_status()
         return response
 
+    def call_api(self, endpoint, data):
+        """
+        POST to an API endpoint, and return the decoded JSON response (using the client's JSON codec).
+        """
+        return self.json_codec.loads(self.post(endpoint, data).content)
+
+    def stream_recordmap(self, endpoint, data):
+        """
+        POST to an endpoint that returns a "recordMap", and return a RecordMapStream that decodes the records
+        incrementally as the response body is downloaded, rather than loading the whole response at once.
+        """
+        response = self.post(endpoint, data, stream=True)
+        return RecordMapStream(response.iter_content(STREAM_CHUNK_SIZE))
+
+    def iter_records(self, endpoint, data):
+        """
+        POST to an endpoint that returns a "recordMap", adding each record to the local store as soon as it has
+        been decoded, and yielding its (table, id) so it can be processed before the rest has downloaded.
+        """
+        return self._store.iter_store_recordmap(self.stream_recordmap(endpoint, data))
+
     def submit_transaction(self, operations, update_last_edited=True):
 
         if not operations:
@@ -286,9 +674,74 @@ class NotionClient(object):
         if self.in_transaction():
             self._transaction_operations += operations
         else:
-            data = {"operations": operations}
-            self.post("submitTransaction", data)
-            self._store.run_local_operations(operations)
+            self._post_transaction(operations)
+
+    def _post_transaction(self, operations):
+        """
+        Send the operations to the submitTransaction endpoint. If the request fails in a way that leaves us unsure
+        whether the server applied it (e.g. a timeout), we reload the affected records to find out, and only retry
+        if it didn't land, so that commands like `listAfter` are never applied twice. Transactions are applied
+        atomically, and their operations depend on each other's order, so it's always all or nothing: we never
+        re-send just some of the operations.
+        """
+
+        request_id = str(uuid.uuid4())
+        records = self._get_transaction_records(operations)
+        versions_before = {
+            (table, id): self._store.get_current_version(table, id) for table, id in records
+        }
+        check_landed = False
+
+        for attempt in range(self.transaction_retries + 1):
+            try:
+                # this needs the network too, so a failure here just counts as another failed attempt
+                if check_landed and self._transaction_landed(versions_before):
+                    logger.debug(
+                        "Transaction {} was applied despite the error".format(request_id)
+                    )
+                    return
+                self.post(
+                    "submitTransaction", {"requestId": request_id, "operations": operations}
+                )
+                break
+            except (RequestsConnectionError, Timeout, HTTPError) as e:
+                retryable = not isinstance(e, HTTPError) or (
+                    e.response is not None and e.response.status_code >= 500
+                )
+                if not retryable or attempt >= self.transaction_retries:
+                    raise
+                logger.warning(
+                    "Problem submitting transaction {}: {} (will check whether it landed and retry {} more times)".format(
+                        request_id, e, self.transaction_retries - attempt
+                    )
+                )
+                check_landed = True
+                time.sleep(0.3 * (2 ** attempt))
+
+        self._store.run_local_operations(operations)
+
+    def _get_transaction_records(self, operations):
+        records = []
+        for operation in operations:
+            record = (operation["table"], operation["id"])
+            if record not in records:
+                records.append(record)
+        return records
+
+    def _transaction_landed(self, versions_before):
+        """
+        Reload the records touched by a transaction from the server, and work out whether it was applied. Every
+        operation bumps the version of the record it touches (and records the transaction creates don't exist
+        beforehand), so if any record is still at the version we had before sending, the transaction didn't land.
+        """
+        record_ids = defaultdict(list)
+        for table, id in versions_before:
+            record_ids[table].append(id)
+        self._store.call_get_record_values(**record_ids)
+        return all(
+            self._store.get_current_version(table, id) > version
+            for (table, id), version in versions_before.items()
+        )
 
     def query_collection(self, *args, **kwargs):
         return self._store.call_query_collection(*args, **kwargs)
@@ -313,7 +766,7 @@ class NotionClient(object):
             "limit": limit,
             "spaceId": self.current_space.id,
         }
-        response = self.post("searchPagesWithParent", data).json()
+        response = self.call_api("searchPagesWithParent", data)
         self._store.store_recordmap(response["recordMap"])
         return response["results"]
 
@@ -356,7 +809,7 @@ class NotionClient(object):
             "sort": sort,
             "source": source,
         }
-        response = self.post("search", data).json()
+        response = self.call_api("search", data)
         self._store.store_recordmap(response["recordMap"])
         return [self.get_block(result["id"]) for result in response["results"]]
 
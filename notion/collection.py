@@ -1,4 +1,5 @@
 from cached_property import cached_property
+from collections import defaultdict
 from copy import deepcopy
 from datetime import datetime, date
 from tzlocal import get_localzone
@@ -7,6 +8,12 @@ from uuid import uuid1
 from .block import Block, PageBlock, Children, CollectionViewBlock
 from .logger import logger
 from .maps import property_map, field_map
+from .localquery import (
+    LocalQueryEngine,
+    UnsupportedQuery,
+    as_date_string,
+    get_plain_value,
+)
 from .markdown import markdown_to_notion, notion_to_markdown
 from .operations import build_operation
 from .records import Record
@@ -134,6 +141,49 @@ class NotionSelect(object):
         return {"id": self.id, "value": self.value, "color": self.color}
 
 
+class SchemaIndex(object):
+    """
+    Lookup tables over a collection's schema, so that finding a property by id, name or type doesn't involve
+    slugifying and scanning every property in the schema. Built once per version of the collection record.
+    """
+
+    def __init__(self, schema):
+        self.properties = []
+        self.by_id = {}
+        self.by_slug = {}
+        self.by_type = defaultdict(list)
+        for id, item in (schema or {}).items():
+            prop = {"id": id, "slug": slugify(item["name"])}
+            prop.update(item)
+            self.properties.append(prop)
+            self.by_id[id] = prop
+            # names may not be unique, in which case we use the first match
+            self.by_slug.setdefault(prop["slug"], prop)
+            self.by_type[prop["type"]].append(prop)
+        self.writable_properties = [
+            prop
+            for prop in self.properties
+            if prop["type"] not in ["formula", "rollup"]
+        ]
+        self.writable_slugs = [prop["slug"] for prop in self.writable_properties]
+        if "title" not in self.writable_slugs:
+            self.writable_slugs.append("title")
+        self.writable_slug_set = set(self.writable_slugs)
+        self._identifier_slugs = {}
+
+    def slugify(self, identifier):
+        slug = self._identifier_slugs.get(identifier)
+        if slug is None:
+            slug = self._identifier_slugs[identifier] = slugify(identifier)
+        return slug
+
+    def get(self, identifier):
+        prop = self.by_id.get(identifier) or self.by_slug.get(self.slugify(identifier))
+        if prop is None and identifier == "title" and self.by_type["title"]:
+            prop = self.by_type["title"][0]
+        return prop
+
+
 class Collection(Record):
     """
     A "collection" corresponds to what's sometimes called a "database" in the Notion UI.
@@ -159,23 +209,54 @@ class Collection(Record):
             self._templates = Templates(parent=self)
         return self._templates
 
+    @property
+    def schema_index(self):
+        """
+        A `SchemaIndex` over the collection's current schema (shared between instances, and rebuilt on update).
+        """
+        self._get_record_data()
+        return self._client._store.get_derived(
+            self._table,
+            self.id,
+            "schema_index",
+            lambda value: SchemaIndex((value or {}).get("schema")),
+        )
+
+    @property
+    def local_query_engine(self):
+        """
+        A `LocalQueryEngine` for evaluating queries against this collection's rows in the local store (shared
+        between instances, and rebuilt when the schema changes).
+        """
+        self._get_record_data()
+        return self._client._store.get_derived(
+            self._table,
+            self.id,
+            "local_query_engine",
+            lambda value: LocalQueryEngine(self._client, self.id, self.schema_index),
+        )
+
+    def load_rows(self):
+        """
+        Load all of the collection's rows into the local store, so that queries with `local=True` can be
+        evaluated without contacting the server (until the rows are more than `max_age` seconds old).
+        """
+        row_ids = self.get_rows(limit=-1)._block_ids
+        self._client._store.set_collection_rows(self.id, row_ids)
+
     def get_schema_properties(self):
         """
         Fetch a flattened list of all properties in the collection's schema.
         """
-        properties = []
-        schema = self.get("schema")
-        for id, item in schema.items():
-            prop = {"id": id, "slug": slugify(item["name"])}
-            prop.update(item)
-            properties.append(prop)
-        return properties
+        return list(self.schema_index.properties)
 
     def check_schema_select_options(self, prop, values):
         """
         Check and update the prop dict with new values
         """
         schema_update = False
+        # copy the prop, as it's shared by the schema index and shouldn't change until the schema is saved
+        prop = dict(prop, options=list(prop.get("options") or []))
         current_options = list([p["value"].lower() for p in prop["options"]])
         if not isinstance(values, list):
             values = [values]
@@ -183,6 +264,7 @@ class Collection(Record):
             if v and v.lower() not in current_options:
                 schema_update = True
                 prop["options"].append(NotionSelect(v).to_dict())
+                current_options.append(v.lower())
         return schema_update, prop
 
     def get_schema_property(self, identifier):
@@ -190,12 +272,66 @@ class Collection(Record):
         Look up a property in the collection's schema, by "property id" (generally a 4-char string),
         or name (human-readable -- there may be duplicates, so we pick the first match we find).
         """
-        for prop in self.get_schema_properties():
-            if identifier == prop["id"] or slugify(identifier) == prop["slug"]:
-                return prop
-            if identifier == "title" and prop["type"] == "title":
-                return prop
-        return None
+        return self.schema_index.get(identifier)
+
+    def update_rows(self, updates, batch_size=500):
+        """
+        Set properties on many rows at once. `updates` maps row IDs (or `CollectionRowBlock`s) to dicts of
+        property names (or ids) and values, as would be set through `CollectionRowBlock.set_property`. Any new
+        select options are added to the schema in the first transaction, and the property changes are submitted in
+        transactions of up to `batch_size` operations, rather than one transaction per property.
+        """
+
+        index = self.schema_index
+        props = {}
+        select_values = defaultdict(list)
+
+        for changes in updates.values():
+            for identifier, val in changes.items():
+                if identifier not in props:
+                    props[identifier] = index.get(identifier)
+                    if props[identifier] is None:
+                        raise AttributeError(
+                            "Collection does not have property '{}'".format(identifier)
+                        )
+                prop = props[identifier]
+                if prop["type"] in ["select", "multi_select"]:
+                    select_values[prop["id"]] += val if isinstance(val, list) else [val]
+
+        # add any new select options to the schema, all in one go
+        updated_props = {}
+        for prop_id, values in select_values.items():
+            schema_update, prop = self.check_schema_select_options(
+                index.by_id[prop_id], values
+            )
+            if schema_update:
+                updated_props[prop_id] = prop
+
+        # set only the options of each changed property (as `set_property` does), so that we don't overwrite
+        # any concurrent edits to the rest of the schema
+        operations = [
+            build_operation(
+                id=self.id,
+                path="schema.{}.options".format(prop_id),
+                args=prop["options"],
+                table=self._table,
+            )
+            for prop_id, prop in updated_props.items()
+        ]
+
+        for row, changes in updates.items():
+            row_id = row.id if isinstance(row, Block) else extract_id(row)
+            row = CollectionRowBlock(self._client, row_id)
+            row.__dict__["collection"] = self
+            for identifier, val in changes.items():
+                prop = updated_props.get(props[identifier]["id"], props[identifier])
+                path, val = row._convert_python_to_notion(
+                    val, prop, identifier=identifier
+                )
+                operations.append(build_operation(id=row_id, path=path, args=val))
+
+        for i in range(0, len(operations), batch_size):
+            self._client.submit_transaction(operations[i : i + batch_size])
 
     def add_row(self, update_views=True, **kwargs):
         """
@@ -238,6 +374,118 @@ class Collection(Record):
     def get_rows(self, **kwargs):
         return self.query(**kwargs)
 
+    def aggregate(self, aggregations, **kwargs):
+        """
+        Compute one or more aggregations over the collection's rows (optionally narrowed down with `filter` or
+        `search`, as for `query`), in a single request that doesn't return the rows themselves. `aggregations`
+        is a list of dicts like `{"property": "estimated_value", "aggregator": "sum", "id": "total_value"}`,
+        and the result is a dict mapping each aggregation's "id" (by default, "<property>_<aggregator>", or just
+        the aggregator if there's no property) to its value.
+        """
+        if isinstance(aggregations, dict):
+            aggregations = [aggregations]
+        query = CollectionQuery(
+            self, self._get_a_collection_view(), aggregations=aggregations, **kwargs
+        )
+        values = query.execute_aggregations()
+        results = {}
+        for aggregation, value in zip(aggregations, values):
+            key = aggregation.get("id")
+            if not key:
+                key = aggregation.get("aggregator") or aggregation.get(
+                    "aggregation_type"
+                )
+                if aggregation.get("property"):
+                    key = "{}_{}".format(aggregation["property"], key)
+            results[key] = value
+        return results
+
+    def to_records(self, columns=None, **kwargs):
+        """
+        Query the collection (with the same keyword arguments as `query`), and return the matching rows as a dict
+        of columns (see `get_columns`). Unlike `query`, all the matching rows are returned unless a `limit` is given.
+        """
+        kwargs.setdefault("limit", -1)
+        return self.query(**kwargs).to_columns(columns=columns)
+
+    def _get_column_props(self, columns=None):
+        index = self.schema_index
+        if columns is None:
+            return [
+                prop
+                for prop in index.writable_properties
+                if index.by_slug[prop["slug"]] is prop
+            ]
+        props = []
+        for identifier in columns:
+            prop = index.get(identifier)
+            if prop is None:
+                raise AttributeError(
+                    "Collection does not have property '{}'".format(identifier)
+                )
+            props.append(prop)
+        return props
+
+    def get_columns(self, row_ids, columns=None):
+        """
+        Decode the properties of the given rows one column at a time, returning a dict that maps "id" and each
+        property's slug to a list of values in the same order as `row_ids`. `columns` is a list of property ids or
+        names to include; by default, all the properties returned by `CollectionRowBlock.get_all_properties`.
+        """
+        props = self._get_column_props(columns)
+
+        row_ids = list(row_ids)
+        rows = self._client._store.get_many("block", row_ids)
+        self._prefetch_references(rows, props)
+        cells = [(row.get("properties") or {}) if row else None for row in rows]
+
+        data = {"id": row_ids}
+        for prop in props:
+            prop_id = prop["id"]
+            decoder = PROPERTY_DECODERS.get(prop["type"])
+            if decoder is None:
+                data[prop["slug"]] = [
+                    None if cell is None else cell.get(prop_id) for cell in cells
+                ]
+            else:
+                data[prop["slug"]] = [
+                    None
+                    if cell is None
+                    else decoder(cell.get(prop_id), self._client, row_id, row)
+                    for row_id, row, cell in zip(row_ids, rows, cells)
+                ]
+        return data
+
+    def prefetch_references(self, row_ids, columns=None):
+        """
+        Load all the users and pages referenced by the given rows' person, relation and created/edited by properties
+        (or just those in `columns`) using as few `getRecordValues` requests as possible, so that decoding those
+        properties afterwards doesn't need a separate request for each referenced record.
+        """
+        rows = self._client._store.get_many("block", list(row_ids))
+        self._prefetch_references(rows, self._get_column_props(columns))
+
+    def _prefetch_references(self, rows, props):
+
+        referenced = defaultdict(set)
+
+        for prop in props:
+            if prop["type"] in REFERENCE_TABLES:
+                table = REFERENCE_TABLES[prop["type"]]
+                for row in rows:
+                    val = ((row or {}).get("properties") or {}).get(prop["id"])
+                    for item in val or []:
+                        if item[0] == "‣":
+                            referenced[table].add(item[1][0][1])
+            elif prop["type"] in ["created_by", "last_edited_by"]:
+                for row in rows:
+                    user_id = (row or {}).get(prop["type"] + "_id")
+                    if user_id:
+                        referenced["notion_user"].add(user_id)
+
+        for table, ids in referenced.items():
+            self._client._store.get_many(table, list(ids))
+
     def _convert_diff_to_changelist(self, difference, old_val, new_val):
 
         changes = []
@@ -347,6 +595,149 @@ def _normalize_query_data(data, collection, recursing=False):
     return data
 
 
+def _decode_text(val, client, row_id, row):
+    return notion_to_markdown(val) if val else ""
+
+
+def _decode_number(val, client, row_id, row):
+    if val is None:
+        return None
+    val = val[0][0]
+    return float(val) if "." in val else int(val)
+
+
+def _decode_select(val, client, row_id, row):
+    return val[0][0] if val else None
+
+
+def _decode_multi_select(val, client, row_id, row):
+    return [v.strip() for v in val[0][0].split(",")] if val else []
+
+
+def _decode_person(val, client, row_id, row):
+    return (
+        [client.get_user(item[1][0][1]) for item in val if item[0] == "‣"]
+        if val
+        else []
+    )
+
+
+def _decode_string(val, client, row_id, row):
+    return val[0][0] if val else ""
+
+
+def _decode_date(val, client, row_id, row):
+    return NotionDate.from_notion(val)
+
+
+def _decode_file(val, client, row_id, row):
+    return (
+        [
+            add_signed_prefix_as_needed(item[1][0][1], client=client, id=row_id)
+            for item in val
+            if item[0] != ","
+        ]
+        if val
+        else []
+    )
+
+
+def _decode_checkbox(val, client, row_id, row):
+    return val[0][0] == "Yes" if val else False
+
+
+def _decode_relation(val, client, row_id, row):
+    return (
+        [client.get_block(item[1][0][1]) for item in val if item[0] == "‣"]
+        if val
+        else []
+    )
+
+
+def _decode_timestamp(type):
+    def decode(val, client, row_id, row):
+        return datetime.utcfromtimestamp(row.get(type) / 1000)
+
+    return decode
+
+
+def _decode_user_field(type):
+    def decode(val, client, row_id, row):
+        return client.get_user(row.get(type + "_id"))
+
+    return decode
+
+
+# the filter operators used to fetch the rows of a group (i.e. with a particular value) when grouping by a property
+GROUP_FILTER_OPERATORS = {
+    "select": "enum_is",
+    "multi_select": "enum_contains",
+    "person": "person_contains",
+    "relation": "relation_contains",
+    "checkbox": "checkbox_is",
+    "number": "number_equals",
+    "title": "string_is",
+    "text": "string_is",
+    "email": "string_is",
+    "phone_number": "string_is",
+    "url": "string_is",
+}
+
+
+# the tables of the records referenced by each type of property that holds a list of mentions
+REFERENCE_TABLES = {"person": "notion_user", "relation": "block"}
+
+
+# functions to convert a property value from the API into Python, given `(val, client, row_id, row)`, where `row`
+# is the row's full record value; property types that aren't listed here are returned as-is
+PROPERTY_DECODERS = {
+    "title": _decode_text,
+    "text": _decode_text,
+    "number": _decode_number,
+    "select": _decode_select,
+    "multi_select": _decode_multi_select,
+    "person": _decode_person,
+    "email": _decode_string,
+    "phone_number": _decode_string,
+    "url": _decode_string,
+    "date": _decode_date,
+    "file": _decode_file,
+    "checkbox": _decode_checkbox,
+    "relation": _decode_relation,
+    "created_time": _decode_timestamp("created_time"),
+    "last_edited_time": _decode_timestamp("last_edited_time"),
+    "created_by": _decode_user_field("created_by"),
+    "last_edited_by": _decode_user_field("last_edited_by"),
+}
+
+
+def _get_query_total(result):
+    if "total" in result:
+        return result["total"]
+    # with the "reducer" loader, the total is returned alongside the results
+    return (
+        result.get("reducerResults", {})
+        .get("collection_group_results", {})
+        .get("total", -1)
+    )
+
+
+def _as_key_list(value):
+    if isinstance(value, list):
+        return value
+    return [] if value is None or value == "" else [value]
+
+
+def _to_plain_value(val):
+    if isinstance(val, list):
+        return [_to_plain_value(item) for item in val]
+    if isinstance(val, NotionDate):
+        return val.start
+    if isinstance(val, Record):
+        return val.id
+    return val
+
+
 class CollectionQuery(object):
     def __init__(
         self,
@@ -356,10 +747,13 @@ class CollectionQuery(object):
         type="table",
         aggregate=[],
         aggregations=[],
+        filter=[],
         sort=[],
         calendar_by="",
         group_by="",
-        limit=100
+        limit=100,
+        local=False,
+        max_age=60,
     ):
         assert not (
             aggregate and aggregations
@@ -370,16 +764,35 @@ class CollectionQuery(object):
         self.type = type
         self.aggregate = _normalize_query_data(aggregate, collection)
         self.aggregations = _normalize_query_data(aggregations, collection)
+        self.filter = _normalize_query_data(filter, collection)
         self.sort = _normalize_query_data(sort, collection)
         self.calendar_by = _normalize_property_name(calendar_by, collection)
         self.group_by = _normalize_property_name(group_by, collection)
         self.limit = limit
+        self.local = local
+        self.max_age = max_age
         self._client = collection._client
 
     def execute(self):
 
         result_class = QUERY_RESULT_TYPES.get(self.type, QueryResult)
 
+        if self.local and self.type != "calendar":
+            # try answering the query from the rows in the local store, if they've been loaded recently enough
+            result = self.collection.local_query_engine.query(
+                filter=self.filter,
+                sort=self.sort,
+                aggregate=self.aggregate,
+                aggregations=self.aggregations,
+                search=self.search,
+                group_by=self.group_by,
+                calendar_by=self.calendar_by,
+                limit=self.limit,
+                max_age=self.max_age,
+            )
+            if result is not None:
+                return result_class(self.collection, result, self)
+
         kwargs = {
             'collection_id':self.collection.id,
             'collection_view_id':self.collection_view.id,
@@ -387,6 +800,7 @@ class CollectionQuery(object):
             'type':self.type,
             'aggregate':self.aggregate,
             'aggregations':self.aggregations,
+            'filter':self.filter,
             'sort':self.sort,
             'calendar_by':self.calendar_by,
             'group_by':self.group_by,
@@ -398,7 +812,7 @@ class CollectionQuery(object):
             result = self._client.query_collection(
                 **kwargs
             )
-            self.limit = result.get("total",-1)
+            self.limit = _get_query_total(result)
 
         kwargs['limit'] = self.limit
 
@@ -410,6 +824,34 @@ class CollectionQuery(object):
             self,
         )
 
+    def execute_aggregations(self):
+        """
+        Run just the query's aggregations, without fetching any rows, and return a list of their values.
+        """
+
+        kwargs = {
+            "filter": self.filter,
+            "sort": [],
+            "search": self.search,
+            "aggregate": self.aggregate,
+            "aggregations": self.aggregations,
+        }
+
+        result = None
+        if self.local:
+            result = self.collection.local_query_engine.query(
+                limit=0, max_age=self.max_age, **kwargs
+            )
+        if result is None:
+            result = self._client.query_collection(
+                collection_id=self.collection.id,
+                collection_view_id=self.collection_view.id,
+                include_rows=False,
+                **kwargs
+            )
+
+        return [agg.get("value") for agg in result.get("aggregationResults", [])]
+
 
 class CollectionRowBlock(PageBlock):
     @property
@@ -422,11 +864,7 @@ class CollectionRowBlock(PageBlock):
 
     @property
     def schema(self):
-        return [
-            prop
-            for prop in self.collection.get_schema_properties()
-            if prop["type"] not in ["formula", "rollup"]
-        ]
+        return list(self.collection.schema_index.writable_properties)
 
     def __getattr__(self, attname):
         return self.get_property(attname)
@@ -435,20 +873,20 @@ class CollectionRowBlock(PageBlock):
         if attname.startswith("_"):
             # we only allow setting of new non-property attributes that start with "_"
             super().__setattr__(attname, value)
-        elif attname in self._get_property_slugs():
+        elif attname in self.collection.schema_index.writable_slug_set:
             self.set_property(attname, value)
-        elif slugify(attname) in self._get_property_slugs():
-            self.set_property(slugify(attname), value)
+        elif (
+            self.collection.schema_index.slugify(attname)
+            in self.collection.schema_index.writable_slug_set
+        ):
+            self.set_property(self.collection.schema_index.slugify(attname), value)
         elif hasattr(self, attname):
             super().__setattr__(attname, value)
         else:
             raise AttributeError("Unknown property: '{}'".format(attname))
 
     def _get_property_slugs(self):
-        slugs = [prop["slug"] for prop in self.schema]
-        if "title" not in slugs:
-            slugs.append("title")
-        return slugs
+        return list(self.collection.schema_index.writable_slugs)
 
     def __dir__(self):
         return self._get_property_slugs() + super().__dir__()
@@ -461,9 +899,28 @@ class CollectionRowBlock(PageBlock):
                 "Object does not have property '{}'".format(identifier)
             )
 
-        val = self.get(["properties", prop["id"]])
+        return self._get_decoded_property(prop)
+
+    def _get_decoded_property(self, prop):
+        """
+        Return the Python value of a property, decoding it only once per version of the row (and schema property).
+        """
+
+        self._get_record_data()
 
-        return self._convert_notion_to_python(val, prop)
+        def decode(row):
+            val = ((row or {}).get("properties") or {}).get(prop["id"])
+            return self._convert_notion_to_python(val, prop)
+
+        val = self._client._store.get_derived(
+            self._table, self.id, ("property", prop["id"], prop["type"]), decode
+        )
+        # copy mutable values, so changes made by the caller don't end up in the cache
+        if isinstance(val, list):
+            return list(val)
+        if isinstance(val, NotionDate):
+            return deepcopy(val)
+        return val
 
     def _convert_diff_to_changelist(self, difference, old_val, new_val):
 
@@ -498,68 +955,18 @@ class CollectionRowBlock(PageBlock):
         )
 
     def _convert_notion_to_python(self, val, prop):
-
-        if prop["type"] in ["title", "text"]:
-            val = notion_to_markdown(val) if val else ""
-        if prop["type"] in ["number"]:
-            if val is not None:
-                val = val[0][0]
-                if "." in val:
-                    val = float(val)
-                else:
-                    val = int(val)
-        if prop["type"] in ["select"]:
-            val = val[0][0] if val else None
-        if prop["type"] in ["multi_select"]:
-            val = [v.strip() for v in val[0][0].split(",")] if val else []
-        if prop["type"] in ["person"]:
-            val = (
-                [self._client.get_user(item[1][0][1]) for item in val if item[0] == "‣"]
-                if val
-                else []
-            )
-        if prop["type"] in ["email", "phone_number", "url"]:
-            val = val[0][0] if val else ""
-        if prop["type"] in ["date"]:
-            val = NotionDate.from_notion(val)
-        if prop["type"] in ["file"]:
-            val = (
-                [
-                    add_signed_prefix_as_needed(
-                        item[1][0][1], client=self._client, id=self.id
-                    )
-                    for item in val
-                    if item[0] != ","
-                ]
-                if val
-                else []
-            )
-        if prop["type"] in ["checkbox"]:
-            val = val[0][0] == "Yes" if val else False
-        if prop["type"] in ["relation"]:
-            val = (
-                [
-                    self._client.get_block(item[1][0][1])
-                    for item in val
-                    if item[0] == "‣"
-                ]
-                if val
-                else []
-            )
-        if prop["type"] in ["created_time", "last_edited_time"]:
-            val = self.get(prop["type"])
-            val = datetime.utcfromtimestamp(val / 1000)
-        if prop["type"] in ["created_by", "last_edited_by"]:
-            val = self.get(prop["type"] + "_id")
-            val = self._client.get_user(val)
-
-        return val
+        decoder = PROPERTY_DECODERS.get(prop["type"])
+        if decoder is None:
+            return val
+        return decoder(val, self._client, self.id, self.get())
 
     def get_all_properties(self):
         allprops = {}
         for prop in self.schema:
-            propid = slugify(prop["name"])
-            allprops[propid] = self.get_property(propid)
+            if prop["slug"] in allprops:
+                # a duplicate name, which resolves to the first property with that name
+                continue
+            allprops[prop["slug"]] = self._get_decoded_property(prop)
         return allprops
 
     def set_property(self, identifier, val):
@@ -713,11 +1120,20 @@ class Templates(Children):
 
 
 class QueryResult(object):
+    """
+    The rows matched by a query, as a lazy sequence of `CollectionRowBlock`s: indexing, slicing and iteration only
+    construct the row objects that are actually used (and each is only constructed once).
+    """
+
     def __init__(self, collection, result, query):
         self.collection = collection
         self._client = collection._client
         self._block_ids = self._get_block_ids(result)
-        self.total = result.get("total", -1)
+        self._block_id_set = None
+        self._blocks = {}
+        self.total = _get_query_total(result)
+        self._group_results = result.get("reducerResults", {}).get("board_columns")
+        self._groups = None
         self.aggregates = result.get("aggregationResults", [])
         self.aggregate_ids = [
             agg.get("id") for agg in (query.aggregate or query.aggregations)
@@ -728,14 +1144,17 @@ class QueryResult(object):
         return result['reducerResults']['collection_group_results']["blockIds"]
 
     def _get_block(self, id):
-        block = CollectionRowBlock(self._client, id)
-        block.__dict__["collection"] = self.collection
+        block = self._blocks.get(id)
+        if block is None:
+            block = CollectionRowBlock(self._client, id)
+            block.__dict__["collection"] = self.collection
+            self._blocks[id] = block
         return block
 
     def get_aggregate(self, id):
         for agg_id, agg in zip(self.aggregate_ids, self.aggregates):
             if id == agg_id:
-                return agg["value"]
+                return agg.get("value")
         return None
 
     def __repr__(self):
@@ -751,13 +1170,15 @@ class QueryResult(object):
         return len(self._block_ids)
 
     def __getitem__(self, key):
-        return list(iter(self))[key]
+        if isinstance(key, slice):
+            return [self._get_block(id) for id in self._block_ids[key]]
+        return self._get_block(self._block_ids[key])
 
     def __iter__(self):
-        return iter(self._get_block(id) for id in self._block_ids)
+        return (self._get_block(id) for id in self._block_ids)
 
     def __reversed__(self):
-        return reversed(iter(self))
+        return (self._get_block(id) for id in reversed(self._block_ids))
 
     def __contains__(self, item):
         if isinstance(item, str):
@@ -766,7 +1187,215 @@ class QueryResult(object):
             item_id = item.id
         else:
             return False
-        return item_id in self._block_ids
+        if self._block_id_set is None:
+            self._block_id_set = set(self._block_ids)
+        return item_id in self._block_id_set
+
+    @property
+    def groups(self):
+        """
+        If the query was grouped (with `group_by`), a list of `QueryGroup`s, one per value of the grouped property;
+        otherwise None. The number of rows in each group is known up front, but a group's rows are only fetched
+        when they're used.
+        """
+        if self._groups is None:
+            self._groups = self._get_groups()
+        return self._groups
+
+    def get_group(self, value):
+        for group in self.groups or []:
+            if group.value == value:
+                return group
+        return None
+
+    def _get_groups(self):
+
+        if not self.query.group_by:
+            return None
+
+        prop = self.collection.schema_index.get(self.query.group_by)
+
+        if self._group_results is None or prop["type"] not in GROUP_FILTER_OPERATORS:
+            # the server didn't return the groups, so group the rows we have
+            return self._group_locally(prop, lambda value: _as_key_list(value))
+
+        groups = []
+        for item in self._group_results.get("results", []):
+            value = (item.get("value") or {}).get("value")
+            groups.append(
+                QueryGroup(
+                    self,
+                    value,
+                    count=(item.get("aggregationResult") or {}).get("value", 0),
+                    filter=self._get_group_filter(prop, value),
+                )
+            )
+        return groups
+
+    def _group_locally(self, prop, get_keys):
+        """
+        Group the result's rows by the keys returned by `get_keys(value)` for each row's (plain) value of `prop`,
+        with rows having no keys going into a group with the value None.
+        """
+
+        groups = {}
+        rows = self._client._store.get_many("block", self._block_ids)
+        for id, row in zip(self._block_ids, rows):
+            if not row:
+                continue
+            try:
+                keys = get_keys(get_plain_value(prop, row))
+            except UnsupportedQuery as e:
+                raise ValueError(str(e))
+            for key in keys or [None]:
+                groups.setdefault(key, []).append(id)
+
+        # order the groups the way Notion does: select options in schema order, and otherwise by value
+        options = [option["value"] for option in prop.get("options") or []]
+        order = {
+            key: (
+                key is None,
+                options.index(key) if key in options else len(options),
+                str(key),
+            )
+            for key in groups
+        }
+        return [
+            QueryGroup(self, key, block_ids=groups[key])
+            for key in sorted(groups, key=order.get)
+        ]
+
+    def _get_group_filter(self, prop, value):
+        if value is None:
+            group_filter = {"operator": "is_empty"}
+        else:
+            group_filter = {
+                "operator": GROUP_FILTER_OPERATORS[prop["type"]],
+                "value": {"type": "exact", "value": value},
+            }
+        filters = [{"property": prop["id"], "filter": group_filter}]
+        if self.query.filter:
+            filters.insert(0, self.query.filter)
+        return {"operator": "and", "filters": filters}
+
+    def _load_group_block_ids(self, group, limit):
+        return CollectionQuery(
+            self.collection,
+            self.query.collection_view,
+            search=self.query.search,
+            sort=self.query.sort,
+            filter=group._filter,
+            limit=limit,
+        ).execute()._block_ids
+
+    def prefetch_references(self, columns=None):
+        """
+        Load the users and pages referenced by the rows' person/relation properties in batches, rather than one at a
+        time as each row's properties are decoded (see `Collection.prefetch_references`).
+        """
+        self.collection.prefetch_references(self._block_ids, columns=columns)
+
+    def iter_pages(self, page_size=100, prefetch_references=False):
+        """
+        Iterate over the rows in lists of up to `page_size`, loading any of each page's records that aren't yet in
+        the local store with one request per page, rather than one request per row. If `prefetch_references` is
+        True (or a list of columns), the records referenced by each page's person/relation properties are loaded
+        in the same way.
+        """
+        for i in range(0, len(self._block_ids), page_size):
+            page_ids = self._block_ids[i : i + page_size]
+            self._client._store.get_many("block", page_ids, chunk_size=page_size)
+            if prefetch_references:
+                self.collection.prefetch_references(
+                    page_ids,
+                    columns=None
+                    if prefetch_references is True
+                    else prefetch_references,
+                )
+            yield [self._get_block(id) for id in page_ids]
+
+    def to_columns(self, columns=None):
+        """
+        Return the rows' properties as a dict of lists, decoded a column at a time (see `Collection.get_columns`).
+        """
+        return self.collection.get_columns(self._block_ids, columns=columns)
+
+    def to_dataframe(self, columns=None):
+        """
+        Return the rows as a `pandas.DataFrame` (requires pandas), indexed by row ID.
+        """
+        try:
+            import pandas
+        except ImportError:
+            raise ImportError("Exporting to a DataFrame requires the 'pandas' package")
+        data = self.to_columns(columns=columns)
+        return pandas.DataFrame(data, index=data.pop("id"))
+
+    def to_arrow(self, columns=None):
+        """
+        Return the rows as a `pyarrow.Table` (requires pyarrow). Since Arrow can't hold arbitrary Python objects,
+        dates are converted to their start date and users/blocks to their IDs.
+        """
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("Exporting to Arrow requires the 'pyarrow' package")
+        return pyarrow.table(
+            {
+                name: [_to_plain_value(val) for val in values]
+                for name, values in self.to_columns(columns=columns).items()
+            }
+        )
+
+
+class QueryGroup(object):
+    """
+    One group of a grouped query result (e.g. a column of a board, or a day of a calendar). The number of rows
+    is known up front, but the rows themselves are only fetched when needed, so renderers can page through each
+    group separately.
+    """
+
+    def __init__(self, result, value, count=None, block_ids=None, filter=None):
+        self.value = value
+        self.count = len(block_ids) if count is None else count
+        self._result = result
+        self._block_ids = block_ids
+        self._filter = filter
+
+    def __repr__(self):
+        return "<QueryGroup (value={}, count={})>".format(repr(self.value), self.count)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.get_rows())
+
+    @property
+    def block_ids(self):
+        return self.get_block_ids()
+
+    def get_block_ids(self, limit=None):
+        """
+        Return the IDs of the group's rows (or the first `limit` of them), fetching them from the server if needed.
+        """
+        if limit is None or limit > self.count:
+            limit = self.count
+        if self._block_ids is None or (
+            len(self._block_ids) < limit and self._filter is not None
+        ):
+            self._block_ids = self._result._load_group_block_ids(self, limit)
+        return self._block_ids[:limit]
+
+    def get_rows(self, offset=0, limit=None):
+        """
+        Return a page of the group's rows, as `CollectionRowBlock`s.
+        """
+        stop = None if limit is None else offset + limit
+        return [
+            self._result._get_block(id) for id in self.get_block_ids(stop)[offset:]
+        ]
+
 
 class TableQueryResult(QueryResult):
 
@@ -782,12 +1411,38 @@ class CalendarQueryResult(QueryResult):
 
     _type = "calendar"
 
+    def __init__(self, collection, result, query):
+        self._weeks = result.get("weeks")
+        super().__init__(collection, result, query)
+
     def _get_block_ids(self, result):
+        if "weeks" not in result:
+            return super()._get_block_ids(result)
         block_ids = []
         for week in result["weeks"]:
             block_ids += week["items"]
         return block_ids
 
+    def _get_groups(self):
+        """
+        Group the rows by week (with the older query format, which returns them that way), or otherwise by the
+        date of the query's `calendar_by` property.
+        """
+
+        if self._weeks is not None:
+            return [
+                QueryGroup(self, week.get("start"), block_ids=week["items"])
+                for week in self._weeks
+            ]
+
+        if not self.query.calendar_by:
+            return super()._get_groups()
+
+        prop = self.collection.schema_index.get(self.query.calendar_by)
+        return self._group_locally(
+            prop, lambda value: [as_date_string(value)] if value else []
+        )
+
 
 class ListQueryResult(QueryResult):
 
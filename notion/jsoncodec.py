@@ -0,0 +1,90 @@
+import json
+
+
+class JSONCodec(object):
+    """
+    The standard library's `json` module, used when no faster codec is installed.
+    """
+
+    name = "json"
+
+    def dumps(self, obj):
+        """
+        Encode `obj` as compact JSON, returning a str.
+        """
+        return json.dumps(obj, separators=(",", ":"))
+
+    def dumpb(self, obj):
+        """
+        Encode `obj` as compact JSON, returning UTF-8 encoded bytes.
+        """
+        return self.dumps(obj).encode()
+
+    def loads(self, data):
+        """
+        Decode JSON from a str or bytes.
+        """
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self._orjson = orjson
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return self.dumpb(obj).decode()
+
+    def dumpb(self, obj):
+        return self._orjson.dumps(obj, option=self._options)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class UjsonCodec(JSONCodec):
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+    def dumpb(self, obj):
+        return self.dumps(obj).encode()
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+# in order of preference, when picking the fastest available codec
+JSON_CODECS = {"orjson": OrjsonCodec, "ujson": UjsonCodec, "json": JSONCodec}
+
+
+def get_json_codec(codec=None):
+    """
+    Return a JSON codec instance. `codec` can be an existing codec instance, the name of one of the codecs in
+    `JSON_CODECS`, or None to pick the fastest one that's installed.
+    """
+    if isinstance(codec, JSONCodec):
+        return codec
+    if codec is not None:
+        if codec not in JSON_CODECS:
+            raise ValueError(
+                "Unknown JSON codec '{}' (options: {})".format(codec, list(JSON_CODECS))
+            )
+        return JSON_CODECS[codec]()
+    for codec_class in JSON_CODECS.values():
+        try:
+            return codec_class()
+        except ImportError:
+            continue
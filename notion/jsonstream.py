@@ -0,0 +1,133 @@
+import codecs
+import json
+
+WHITESPACE = " \t\n\r"
+
+_decoder = json.JSONDecoder()
+
+
+class JSONChunkReader(object):
+    """
+    A minimal pull parser over an iterable of byte (or str) chunks, e.g. `response.iter_content()`. It lets the
+    caller walk the outer layers of a JSON document structurally, and decodes inner values whole, only keeping
+    the not-yet-consumed part of the document in memory.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, min_size=1):
+        """
+        Read chunks until at least `min_size` unconsumed characters are buffered. Returns False if we've hit
+        the end of the input without reading anything new.
+        """
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos :]
+        self._pos = 0
+        start_len = len(self._buf)
+        parts = [self._buf]
+        size = start_len
+        for chunk in self._chunks:
+            text = self._utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+            parts.append(text)
+            size += len(text)
+            if size >= min_size:
+                break
+        else:
+            parts.append(self._utf8.decode(b"", final=True))
+            self._eof = True
+        self._buf = "".join(parts)
+        return len(self._buf) > start_len
+
+    def peek(self):
+        """
+        Return the next non-whitespace character without consuming it (or "" at the end of the input).
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(
+                "Expected '{}' at position {} of JSON stream, found '{}'".format(
+                    char, self._pos, found
+                )
+            )
+        self._pos += 1
+
+    def read_value(self):
+        """
+        Decode and consume the next complete JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # the value isn't complete yet; grow the buffer geometrically so large values decode in linear time
+                if not self._fill(2 * (len(self._buf) - self._pos) + 1):
+                    raise
+                continue
+            if end == len(self._buf) and not self._eof and isinstance(value, (int, float)):
+                # a number at the very end of the buffer may continue in the next chunk
+                self._fill(len(self._buf) - self._pos + 1)
+                continue
+            self._pos = end
+            return value
+
+    def iter_object_keys(self):
+        """
+        Consume a JSON object, yielding each of its keys. After each key is yielded, the caller must consume the
+        corresponding value (with `read_value`, or by walking into it) before advancing the iterator.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self._pos += 1
+            else:
+                self.expect("}")
+                return
+
+
+class RecordMapStream(object):
+    """
+    Incrementally decodes an API response of the form `{"recordMap": {table: {id: record}}, ...}`, yielding
+    `(table, id, record)` for each record as soon as it has been received. Once iteration is complete, the
+    response's other top-level keys (e.g. "result" or "cursor") are available in the `data` dict.
+    """
+
+    def __init__(self, chunks, recordmap_key="recordMap"):
+        self._chunks = chunks
+        self.recordmap_key = recordmap_key
+        self.data = {}
+
+    def __iter__(self):
+        reader = JSONChunkReader(self._chunks)
+        for key in reader.iter_object_keys():
+            if key != self.recordmap_key or reader.peek() != "{":
+                self.data[key] = reader.read_value()
+                continue
+            for table in reader.iter_object_keys():
+                if reader.peek() != "{":
+                    # e.g. a "__version__" marker rather than a table of records
+                    reader.read_value()
+                    continue
+                for id in reader.iter_object_keys():
+                    yield table, id, reader.read_value()
@@ -0,0 +1,514 @@
+import statistics
+
+from collections import defaultdict
+from datetime import datetime
+
+from .logger import logger
+
+
+class UnsupportedQuery(Exception):
+    """
+    Raised internally when a query uses something that can't be evaluated locally, so it has to go to the server.
+    """
+
+    pass
+
+
+def _plain_text(val):
+    return "".join(segment[0] for segment in val) if val else None
+
+
+def _plain_date(val):
+    if not val:
+        return None
+    data = val[0][1][0][1]
+    if data.get("start_time"):
+        return "{} {}".format(data["start_date"], data["start_time"])
+    return data.get("start_date")
+
+
+def _plain_mentions(val):
+    return [item[1][0][1] for item in val if item[0] == "‣"] if val else []
+
+
+def _plain_files(val):
+    return [item[1][0][1] for item in val if item[0] != ","] if val else []
+
+
+# functions to convert a property value from the API into a plain value (str, float, bool, list of str, or None)
+# that filters, sorts and aggregations can be evaluated against; unlike `PROPERTY_DECODERS` in collection.py,
+# these never need to load other records (so people and relations are left as lists of IDs)
+PLAIN_VALUE_GETTERS = {
+    "title": _plain_text,
+    "text": _plain_text,
+    "email": _plain_text,
+    "phone_number": _plain_text,
+    "url": _plain_text,
+    "select": _plain_text,
+    "multi_select": lambda val: (
+        [v.strip() for v in val[0][0].split(",")] if val else []
+    ),
+    "number": lambda val: float(val[0][0]) if val else None,
+    "checkbox": lambda val: val[0][0] == "Yes" if val else False,
+    "date": _plain_date,
+    "person": _plain_mentions,
+    "relation": _plain_mentions,
+    "file": _plain_files,
+}
+
+ROW_FIELD_TYPES = {
+    "created_time": "created_time",
+    "last_edited_time": "last_edited_time",
+    "created_by": "created_by_id",
+    "last_edited_by": "last_edited_by_id",
+}
+
+# filter operators that test for equality with (or membership of) a single value, so can be answered from an index
+INDEXABLE_OPERATORS = {
+    "string_is": False,
+    "string_is_not": True,
+    "enum_is": False,
+    "enum_is_not": True,
+    "enum_contains": False,
+    "enum_does_not_contain": True,
+    "checkbox_is": False,
+    "checkbox_is_not": True,
+    "number_equals": False,
+    "number_does_not_equal": True,
+    "relation_contains": False,
+    "relation_does_not_contain": True,
+    "person_contains": False,
+    "person_does_not_contain": True,
+}
+
+
+def get_plain_value(prop, row):
+    """
+    Return the plain value of a property (see `PLAIN_VALUE_GETTERS`) from a row's record value.
+    """
+    if prop["type"] in ROW_FIELD_TYPES:
+        return row.get(ROW_FIELD_TYPES[prop["type"]])
+    if prop["type"] not in PLAIN_VALUE_GETTERS:
+        raise UnsupportedQuery(
+            "Properties of type '{}' can't be queried locally".format(prop["type"])
+        )
+    val = (row.get("properties") or {}).get(prop["id"])
+    return PLAIN_VALUE_GETTERS[prop["type"]](val)
+
+
+def _is_empty(value):
+    return value is None or value == "" or value == []
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    return [] if _is_empty(value) else [value]
+
+
+def _index_key(value):
+    if isinstance(value, str):
+        return value.lower()
+    return value
+
+
+def as_date_string(value):
+    """
+    Return the "YYYY-MM-DD" date of a plain date value, or of a timestamp in ms.
+    """
+    if isinstance(value, (int, float)):
+        return datetime.utcfromtimestamp(value / 1000).strftime("%Y-%m-%d")
+    return value[:10] if value else None
+
+
+def _filter_value(filter):
+    value = filter.get("value")
+    if isinstance(value, dict):
+        if value.get("type") == "exact":
+            value = value.get("value")
+        elif value.get("type") != "date":
+            raise UnsupportedQuery(
+                "Filter value type '{}' can't be evaluated locally".format(
+                    value.get("type")
+                )
+            )
+    if isinstance(value, dict):
+        if value.get("type") == "date":
+            return value.get("start_date")
+        if "id" in value:
+            return value["id"]
+    return value
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.lower() == "true"
+    return bool(value)
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise UnsupportedQuery("Invalid number in filter: {}".format(value))
+
+
+def _compare(operator, value, target):
+    """
+    Evaluate a single filter operator against a plain cell value.
+    """
+
+    if operator == "is_empty":
+        return _is_empty(value)
+    if operator == "is_not_empty":
+        return not _is_empty(value)
+
+    if operator.startswith("string_"):
+        value = (value or "").lower()
+        target = str(target or "").lower()
+        if operator == "string_is":
+            return value == target
+        if operator == "string_is_not":
+            return value != target
+        if operator == "string_contains":
+            return target in value
+        if operator == "string_does_not_contain":
+            return target not in value
+        if operator == "string_starts_with":
+            return value.startswith(target)
+        if operator == "string_ends_with":
+            return value.endswith(target)
+
+    if operator.startswith("number_"):
+        target = _to_number(target)
+        if operator == "number_does_not_equal":
+            return value != target
+        if value is None:
+            return False
+        if operator == "number_equals":
+            return value == target
+        if operator == "number_greater_than":
+            return value > target
+        if operator == "number_less_than":
+            return value < target
+        if operator == "number_greater_than_or_equal_to":
+            return value >= target
+        if operator == "number_less_than_or_equal_to":
+            return value <= target
+
+    if operator.startswith(("enum_", "relation_", "person_")):
+        values = [_index_key(v) for v in _as_list(value)]
+        found = _index_key(target) in values
+        if operator in INDEXABLE_OPERATORS:
+            return not found if INDEXABLE_OPERATORS[operator] else found
+
+    if operator == "checkbox_is":
+        return bool(value) == _to_bool(target)
+    if operator == "checkbox_is_not":
+        return bool(value) != _to_bool(target)
+
+    if operator.startswith("date_"):
+        value = as_date_string(value)
+        target = as_date_string(target)
+        if value is None or target is None:
+            return False
+        if operator == "date_is":
+            return value == target
+        if operator == "date_is_before":
+            return value < target
+        if operator == "date_is_after":
+            return value > target
+        if operator == "date_is_on_or_before":
+            return value <= target
+        if operator == "date_is_on_or_after":
+            return value >= target
+
+    raise UnsupportedQuery(
+        "Filter operator '{}' can't be evaluated locally".format(operator)
+    )
+
+
+def _sort_key(value):
+    # sort empty values last, and make values of mixed types comparable
+    if _is_empty(value):
+        return (1, 0, "")
+    if isinstance(value, list):
+        value = ",".join(str(v) for v in value)
+    if isinstance(value, (bool, int, float)):
+        return (0, 0, float(value))
+    return (0, 1, str(value).lower())
+
+
+def _aggregate(aggregator, values):
+    """
+    Compute a Notion aggregation (e.g. "count", "sum", "percent_empty") over a column of plain values.
+    """
+
+    if aggregator == "count":
+        return len(values)
+    if aggregator == "count_values":
+        return sum(len(_as_list(v)) for v in values)
+    if aggregator == "unique":
+        return len(set(_index_key(item) for v in values for item in _as_list(v)))
+    if aggregator in ["empty", "not_empty", "percent_empty", "percent_not_empty"]:
+        count = sum(1 for v in values if _is_empty(v))
+        if "not_empty" in aggregator:
+            count = len(values) - count
+        if aggregator.startswith("percent_"):
+            return 100.0 * count / len(values) if values else 0
+        return count
+
+    numbers = [
+        v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)
+    ]
+    if aggregator == "sum":
+        return sum(numbers)
+    if not numbers and aggregator in ["average", "median", "min", "max", "range"]:
+        return None
+    if aggregator == "average":
+        return sum(numbers) / len(numbers)
+    if aggregator == "median":
+        return statistics.median(numbers)
+    if aggregator == "min":
+        return min(numbers)
+    if aggregator == "max":
+        return max(numbers)
+    if aggregator == "range":
+        return max(numbers) - min(numbers)
+
+    raise UnsupportedQuery(
+        "Aggregation '{}' can't be evaluated locally".format(aggregator)
+    )
+
+
+class LocalQueryEngine(object):
+    """
+    Evaluates collection queries (filters, sorts and aggregations, in the same forms accepted by `CollectionQuery`)
+    against the rows already in the local record store, instead of sending a `queryCollection` request. Property
+    values are extracted a column at a time and kept until the collection's rows change, and properties that are
+    repeatedly filtered on for equality get a hash index.
+
+    Queries that can't be answered locally (because the rows haven't been loaded, or were loaded too long ago, or
+    the query uses full-text search, grouping, or an unsupported operator) return None, so the caller can fall
+    back to the server.
+    """
+
+    # build an index on a property once it's been used in this many equality filters
+    index_threshold = 2
+
+    def __init__(self, client, collection_id, schema_index):
+        self._client = client
+        self._store = client._store
+        self.collection_id = collection_id
+        self.schema_index = schema_index
+        self._revision = None
+        self._row_ids = []
+        self._rows = {}
+        self._columns = {}
+        self._indexes = {}
+        self._filter_counts = defaultdict(int)
+        self._complete = False
+
+    def _refresh(self):
+        revision = self._store.get_collection_revision(self.collection_id)
+        if revision == self._revision:
+            return
+        self._row_ids = list(self._store.get_collection_rows(self.collection_id))
+        self._rows = {}
+        self._complete = True
+        for row_id in self._row_ids:
+            row = self._store._get("block", row_id)
+            if not row:
+                self._complete = False
+            elif row.get("alive", True):
+                self._rows[row_id] = row
+        self._row_ids = [row_id for row_id in self._row_ids if row_id in self._rows]
+        self._columns = {}
+        self._indexes = {}
+        self._revision = revision
+
+    def is_available(self, max_age=None):
+        """
+        Check whether all of the collection's rows have been loaded (and its list of rows refreshed within the last
+        `max_age` seconds, if not None).
+        """
+        age = self._store.get_collection_rows_age(self.collection_id)
+        if age is None or (max_age is not None and age > max_age):
+            return False
+        self._refresh()
+        return self._complete
+
+    def _get_prop(self, prop_id):
+        prop = self.schema_index.get(prop_id)
+        if prop is None:
+            raise UnsupportedQuery("Unknown property '{}'".format(prop_id))
+        return prop
+
+    def get_column(self, prop_id):
+        """
+        Return a dict mapping each row ID to the plain value of the given property.
+        """
+        if prop_id not in self._columns:
+            prop = self._get_prop(prop_id)
+            if prop["type"] in ROW_FIELD_TYPES:
+                field = ROW_FIELD_TYPES[prop["type"]]
+                column = {id: row.get(field) for id, row in self._rows.items()}
+            elif prop["type"] in PLAIN_VALUE_GETTERS:
+                getter = PLAIN_VALUE_GETTERS[prop["type"]]
+                column = {
+                    id: getter((row.get("properties") or {}).get(prop["id"]))
+                    for id, row in self._rows.items()
+                }
+            else:
+                raise UnsupportedQuery(
+                    "Properties of type '{}' can't be queried locally".format(
+                        prop["type"]
+                    )
+                )
+            self._columns[prop_id] = column
+        return self._columns[prop_id]
+
+    def get_index(self, prop_id):
+        """
+        Return a hash index (a dict mapping each lowercased value to the set of row IDs having it) for a property.
+        """
+        if prop_id not in self._indexes:
+            index = defaultdict(set)
+            for row_id, value in self.get_column(prop_id).items():
+                for item in _as_list(value):
+                    index[_index_key(item)].add(row_id)
+            self._indexes[prop_id] = index
+        return self._indexes[prop_id]
+
+    def _match(self, node, candidates):
+        """
+        Return the subset of the `candidates` set of row IDs that match the filter `node`.
+        """
+
+        if "filters" in node:
+            operator = node.get("operator", "and")
+            if operator == "and":
+                # handle the leaves we have indexes for first, as they narrow down the candidates most cheaply
+                filters = sorted(
+                    node["filters"],
+                    key=lambda f: f.get("property") not in self._indexes,
+                )
+                for child in filters:
+                    candidates = self._match(child, candidates)
+                    if not candidates:
+                        break
+                return candidates
+            elif operator == "or":
+                matched = set()
+                for child in node["filters"]:
+                    matched |= self._match(child, candidates - matched)
+                return matched
+            raise UnsupportedQuery("Unknown filter operator '{}'".format(operator))
+
+        prop_id = self._get_prop(node.get("property"))["id"]
+        filter = node.get("filter") or {}
+        operator = filter.get("operator")
+        target = _filter_value(filter)
+
+        # (empty rows aren't in the indexes, so comparisons with an empty value need a scan)
+        if operator in INDEXABLE_OPERATORS and not _is_empty(target):
+            self._filter_counts[prop_id] += 1
+            if (
+                prop_id in self._indexes
+                or self._filter_counts[prop_id] >= self.index_threshold
+            ):
+                if operator.startswith("number_"):
+                    target = _to_number(target)
+                elif operator.startswith("checkbox_"):
+                    target = _to_bool(target)
+                matched = self.get_index(prop_id).get(_index_key(target), set())
+                if INDEXABLE_OPERATORS[operator]:
+                    return candidates - matched
+                return candidates & matched
+
+        column = self.get_column(prop_id)
+        return set(id for id in candidates if _compare(operator, column[id], target))
+
+    def _sort(self, row_ids, sort):
+        for item in reversed(sort or []):
+            column = self.get_column(self._get_prop(item.get("property"))["id"])
+            descending = item.get("direction") == "descending"
+            # keep empty values last regardless of direction
+            row_ids.sort(key=lambda id: _sort_key(column[id]), reverse=descending)
+            if descending:
+                row_ids.sort(key=lambda id: _is_empty(column[id]))
+        return row_ids
+
+    def _aggregate(self, aggregations, row_ids):
+        results = []
+        for aggregation in aggregations:
+            aggregator = aggregation.get("aggregator") or aggregation.get(
+                "aggregation_type"
+            )
+            if aggregator == "count" and not aggregation.get("property"):
+                values = row_ids
+            else:
+                column = self.get_column(
+                    self._get_prop(aggregation.get("property"))["id"]
+                )
+                values = [column[id] for id in row_ids]
+            results.append(
+                {"type": "number", "value": _aggregate(aggregator, values)}
+            )
+        return results
+
+    def query(
+        self,
+        filter=None,
+        sort=[],
+        aggregate=[],
+        aggregations=[],
+        search="",
+        group_by="",
+        calendar_by="",
+        limit=-1,
+        max_age=60,
+    ):
+        """
+        Evaluate a query locally, returning a result in the same shape as the server's, or None if it can't be
+        answered locally (see the class docstring). Property references must already be normalized to property
+        IDs, as done by `CollectionQuery`.
+        """
+
+        if search or group_by or calendar_by:
+            return None
+        if not self.is_available(max_age=max_age):
+            return None
+
+        if isinstance(sort, dict):
+            sort = [sort]
+        if isinstance(aggregate, dict):
+            aggregate = [aggregate]
+
+        try:
+            if filter and filter.get("filters"):
+                matched = self._match(filter, set(self._row_ids))
+                row_ids = [id for id in self._row_ids if id in matched]
+            else:
+                row_ids = list(self._row_ids)
+            row_ids = self._sort(row_ids, sort)
+            aggregation_results = self._aggregate(aggregate or aggregations, row_ids)
+        except UnsupportedQuery as e:
+            logger.debug("Falling back to querying the server: {}".format(e))
+            return None
+
+        total = len(row_ids)
+        if limit is not None and limit >= 0:
+            row_ids = row_ids[:limit]
+
+        return {
+            "reducerResults": {
+                "collection_group_results": {
+                    "type": "results",
+                    "blockIds": row_ids,
+                    "total": total,
+                }
+            },
+            "aggregationResults": aggregation_results,
+            "total": total,
+        }
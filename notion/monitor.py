@@ -1,119 +1,278 @@
-import json
+import random
 import re
 import requests
 import threading
 import time
 import uuid
 
+from bisect import bisect_left
 from collections import defaultdict
 from inspect import signature
-from requests import HTTPError
 
-from .collection import Collection
 from .logger import logger
 from .records import Record
 
 
-class Monitor(object):
+try:
+    import websocket
+except ImportError:
+    websocket = None
 
-    thread = None
 
-    def __init__(self, client, root_url="https://msgstore.www.notion.so/primus/"):
-        self.client = client
+# states of a MonitorSession's polling loop
+CONNECTING = "connecting"
+CONNECTED = "connected"
+BACKOFF = "backoff"
+STOPPED = "stopped"
+
+
+# characters outside the Basic Multilingual Plane, which take up two UTF-16 code units
+NON_BMP_RE = re.compile("[\U00010000-\U0010FFFF]")
+
+
+def _utf16_len(text):
+    # Engine.IO payload lengths are JavaScript string lengths, which count characters outside the BMP twice
+    return len(text) + len(NON_BMP_RE.findall(text))
+
+
+def decode_payload(payload):
+    """
+    Split an Engine.IO (v3) polling payload, which looks like `<length>:<packet><length>:<packet>...`, into its
+    packets. We walk the payload once, jumping ahead by each packet's declared length, so packet contents (which
+    may contain anything, including nested JSON) never need to be scanned for delimiters.
+    """
+
+    packets = []
+    pos = 0
+    # positions of the characters that count as two code units towards the declared lengths
+    wide_chars = [match.start() for match in NON_BMP_RE.finditer(payload)]
+
+    while pos < len(payload):
+        colon = payload.find(":", pos)
+        if colon == -1 or not payload[pos:colon].isdigit():
+            logger.debug(
+                "Could not parse monitoring payload at position {}: {}".format(
+                    pos, payload[pos : pos + 100]
+                )
+            )
+            break
+        length = int(payload[pos:colon])
+        start = colon + 1
+        # walk forward over the wide characters within the packet, each of which makes it one character shorter
+        extra = 0
+        i = bisect_left(wide_chars, start)
+        while i < len(wide_chars) and wide_chars[i] - start + extra < length:
+            extra += 1
+            i += 1
+        end = start + length - extra
+        packets.append(payload[start:end])
+        pos = end
+
+    return packets
+
+
+def encode_payload(packets):
+    """
+    Join a list of Engine.IO packets into a polling payload (the inverse of `decode_payload`).
+    """
+    return "".join("{}:{}".format(_utf16_len(packet), packet) for packet in packets)
+
+
+class MonitorSession(object):
+    """
+    A single Engine.IO session with the message store, holding one shard of the Monitor's subscriptions. Each
+    session has its own connection (and polling thread), and reconnects independently of the others.
+    """
+
+    # maximum number of subscriptions to register in a single request
+    subscription_batch_size = 500
+
+    # backoff (in seconds) after failed polls, and how many consecutive failures before we start a new session
+    base_backoff = 0.5
+    max_backoff = 60
+    reconnect_after_failures = 3
+
+    def __init__(self, monitor, index):
+        self.monitor = monitor
+        self.index = index
+        self.client = monitor.client
+        self.root_url = monitor.root_url
+        self.transport = monitor.transport
         self.session_id = str(uuid.uuid4())
-        self.root_url = root_url
+        self.thread = None
+        self.state = CONNECTING
+        self.polls = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.last_poll_latency = None
+        self.last_poll_time = None
+        self._stopping = threading.Event()
+        self._needs_reconnect = False
+        self._websocket = None
         self._subscriptions = set()
         self.initialize()
+        self.state = CONNECTED
 
     def _decode_numbered_json_thing(self, thing):
+        return self._handle_packets(decode_payload(thing.decode().strip()))
 
-        thing = thing.decode().strip()
-
-        for ping in re.findall('\d+:\d+"primus::ping::\d+"', thing):
-            logger.debug("Received ping: {}".format(ping))
-            self.post_data(ping.replace("::ping::", "::pong::"))
+    def _handle_packets(self, packets):
+        """
+        Handle a list of Engine.IO packets: answer any Primus pings, and return the decoded JSON objects from the
+        "open" and "message" packets.
+        """
 
         results = []
-        for blob in re.findall("\d+:\d+(\{.*?\})(?=\d|$)", thing):
-            results.append(json.loads(blob))
-        if thing and not results and "::ping::" not in thing:
-            logger.debug("Could not parse monitoring response: {}".format(thing))
+
+        for packet in packets:
+
+            # "0" is the Engine.IO packet type for the handshake, and "4" for a message; others carry no data for us
+            if not packet or packet[0] not in "04":
+                continue
+
+            try:
+                data = self.client.json_codec.loads(packet[1:])
+            except ValueError:
+                logger.debug("Could not parse monitoring packet: {}".format(packet))
+                continue
+
+            if isinstance(data, str) and data.startswith("primus::ping::"):
+                logger.debug("Received ping: {}".format(data))
+                self._send([data.replace("::ping::", "::pong::")])
+            elif isinstance(data, dict):
+                results.append(data)
+
         return results
 
+    def _encode_packet(self, obj):
+        # "4" is the Engine.IO packet type for a message
+        return "4" + self.client.json_codec.dumps(obj)
+
     def _encode_numbered_json_thing(self, data):
         assert isinstance(data, list)
-        results = ""
-        for obj in data:
-            msg = str(len(obj)) + json.dumps(obj, separators=(",", ":"))
-            msg = "{}:{}".format(len(msg), msg)
-            results += msg
-        return results.encode()
+        return encode_payload([self._encode_packet(obj) for obj in data]).encode()
+
+    def _request(self, method, url, **kwargs):
+        return self.client._rate_limiter.request(
+            "monitor", lambda: self.client.session.request(method, url, **kwargs)
+        )
 
     def initialize(self):
 
-        logger.debug("Initializing new monitoring session.")
+        logger.debug("Initializing new monitoring session {}.".format(self.index))
+
+        self._close_websocket()
+        self._needs_reconnect = False
 
-        response = self.client.session.get(
+        response = self._request(
+            "GET",
             "{}?sessionId={}&EIO=3&transport=polling".format(
                 self.root_url, self.session_id
-            )
+            ),
         )
 
-        self.sid = self._decode_numbered_json_thing(response.content)[0]["sid"]
+        handshake = self._decode_numbered_json_thing(response.content)[0]
+        self.sid = handshake["sid"]
+        self.ping_interval = handshake.get("pingInterval", 25000) / 1000
 
         logger.debug("New monitoring session ID is: {}".format(self.sid))
 
-        # resubscribe to any existing subscriptions if we're reconnecting
-        old_subscriptions, self._subscriptions = self._subscriptions, set()
-        self.subscribe(old_subscriptions)
-
-    def subscribe(self, records):
+        if self.transport == "websocket" and "websocket" in handshake.get(
+            "upgrades", []
+        ):
+            self._upgrade_to_websocket()
 
-        if isinstance(records, set):
-            records = list(records)
+        # resubscribe to any existing subscriptions if we're reconnecting
+        with self.monitor._sessions_lock:
+            subscriptions = list(self._subscriptions)
+        self._send_subscriptions(subscriptions)
+
+    def _upgrade_to_websocket(self):
+        """
+        Upgrade the Engine.IO session from polling to a websocket, leaving us on polling if anything goes wrong.
+        """
+
+        if websocket is None:
+            logger.warning(
+                "The 'websocket-client' package is not installed; falling back to polling for monitoring."
+            )
+            return
 
-        if not isinstance(records, list):
-            records = [records]
+        url = "{}?sessionId={}&EIO=3&transport=websocket&sid={}".format(
+            self.root_url.replace("https://", "wss://", 1), self.session_id, self.sid
+        )
+        cookie = "; ".join(
+            "{}={}".format(name, value)
+            for name, value in self.client.session.cookies.items()
+        )
 
-        sub_data = []
+        try:
+            ws = websocket.create_connection(
+                url, cookie=cookie, timeout=self.ping_interval
+            )
+            ws.send("2probe")
+            if ws.recv() != "3probe":
+                raise websocket.WebSocketException("Unexpected response to probe")
+            ws.send("5")
+        except (websocket.WebSocketException, OSError) as e:
+            logger.warning(
+                "Could not upgrade monitoring session to websocket ({}); falling back to polling.".format(
+                    e
+                )
+            )
+            return
 
-        for record in records:
+        logger.debug("Upgraded monitoring session {} to websocket".format(self.sid))
+        self._websocket = ws
+        self._last_ping = time.time()
 
-            if record not in self._subscriptions:
+    def _close_websocket(self):
+        if self._websocket is None:
+            return
+        try:
+            self._websocket.close()
+        except (websocket.WebSocketException, OSError):
+            pass
+        self._websocket = None
 
-                logger.debug(
-                    "Subscribing new record to the monitoring watchlist: {}/{}".format(
-                        record._table, record.id
-                    )
-                )
+    def _send(self, messages):
+        """
+        Send a list of messages to the server, over whichever transport is currently active.
+        """
 
-                # add the record to the list of records to restore if we're disconnected
-                self._subscriptions.add(record)
-
-                # subscribe to changes to the record itself
-                sub_data.append(
-                    {
-                        "type": "/api/v1/registerSubscription",
-                        "requestId": str(uuid.uuid4()),
-                        "key": "versions/{}:{}".format(record.id, record._table),
-                        "version": record.get("version", -1),
-                    }
-                )
+        if not messages:
+            return
 
-                # if it's a collection, subscribe to changes to its children too
-                if isinstance(record, Collection):
-                    sub_data.append(
-                        {
-                            "type": "/api/v1/registerSubscription",
-                            "requestId": str(uuid.uuid4()),
-                            "key": "collection/{}".format(record.id),
-                            "version": -1,
-                        }
-                    )
+        if self._websocket is None:
+            self.post_data(self._encode_numbered_json_thing(messages))
+            return
 
-        data = self._encode_numbered_json_thing(sub_data)
+        logger.debug("Sending monitoring messages over websocket: {}".format(messages))
+        for message in messages:
+            self._websocket.send(self._encode_packet(message))
+
+    def _send_subscriptions(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), self.subscription_batch_size):
+            self._send(
+                [
+                    self._build_subscription(key)
+                    for key in keys[i : i + self.subscription_batch_size]
+                ]
+            )
 
-        self.post_data(data)
+    def _build_subscription(self, key):
+        version = -1
+        match = re.match("versions/([^\:]+):(.+)", key)
+        if match:
+            record_id, record_table = match.groups()
+            version = self.client._store.get_current_version(record_table, record_id)
+        return {
+            "type": "/api/v1/registerSubscription",
+            "requestId": str(uuid.uuid4()),
+            "key": key,
+            "version": version,
+        }
 
     def post_data(self, data):
 
@@ -122,52 +281,332 @@ class Monitor(object):
 
         logger.debug("Posting monitoring data: {}".format(data))
 
-        self.client.session.post(
+        self._request(
+            "POST",
             "{}?sessionId={}&transport=polling&sid={}".format(
                 self.root_url, self.session_id, self.sid
             ),
             data=data,
         )
 
-    def poll(self, retries=10):
-        logger.debug("Starting new long-poll request")
+    def poll(self):
+        """
+        Make a single long-poll request (or wait for a single websocket frame), and handle any resulting events.
+        Errors are raised to the caller; `poll_forever` takes care of backing off and reconnecting.
+        """
+
+        if self._websocket is not None:
+            return self._poll_websocket()
+
+        logger.debug("Starting new long-poll request (session {})".format(self.index))
+
+        started = time.time()
+        response = self._request(
+            "GET",
+            "{}?sessionId={}&EIO=3&transport=polling&sid={}".format(
+                self.root_url, self.session_id, self.sid
+            ),
+        )
+        if 400 <= response.status_code < 500:
+            # most likely the server has forgotten our session, so we'll need to start a new one
+            self._needs_reconnect = True
+        response.raise_for_status()
+        self._record_poll(time.time() - started)
+
+        self.monitor._refresh_updated_records(
+            self._decode_numbered_json_thing(response.content)
+        )
+
+    def _poll_websocket(self):
+        """
+        Wait (for up to one ping interval) for the next frame on the websocket, and handle it. We're responsible
+        for sending Engine.IO heartbeat pings, so this also sends one whenever it's due.
+        """
+
+        started = time.time()
+
         try:
-            response = self.client.session.get(
-                "{}?sessionId={}&EIO=3&transport=polling&sid={}".format(
-                    self.root_url, self.session_id, self.sid
-                )
-            )
-            response.raise_for_status()
-        except HTTPError as e:
-            try:
-                message = "{} / {}".format(response.content, e)
-            except:
-                message = "{}".format(e)
-            logger.warn(
-                "Problem with submitting polling request: {} (will retry {} more times)".format(
-                    message, retries
-                )
-            )
-            time.sleep(0.1)
-            if retries <= 0:
-                raise
-            if retries <= 5:
-                logger.error(
-                    "Persistent error submitting polling request: {} (will retry {} more times)".format(
-                        message, retries
+            if started - self._last_ping >= self.ping_interval:
+                self._websocket.send("2")
+                self._last_ping = started
+            frame = self._websocket.recv()
+        except websocket.WebSocketTimeoutException:
+            self._record_poll(time.time() - started)
+            return
+        except (websocket.WebSocketException, OSError):
+            self._close_websocket()
+            self._needs_reconnect = True
+            raise
+
+        self._record_poll(time.time() - started)
+
+        # each websocket frame carries a single packet, with no length prefix
+        events = self._handle_packets([frame])
+        if events:
+            self.monitor._refresh_updated_records(events)
+
+    def _record_poll(self, latency):
+        self.last_poll_time = time.time()
+        self.polls += 1
+        self.last_poll_latency = latency
+
+    def _backoff_delay(self, failures):
+        # exponential backoff with "full jitter", so that many clients don't all reconnect in lockstep
+        # (the exponent is capped, since an outage of many hours would otherwise overflow the float arithmetic)
+        ceiling = min(
+            self.max_backoff, self.base_backoff * (2 ** min(failures - 1, 16))
+        )
+        return random.uniform(0, ceiling)
+
+    def poll_async(self):
+        if self.thread:
+            # Already polling async; no need to have two threads
+            return
+        self.thread = threading.Thread(target=self.poll_forever, daemon=True)
+        self.thread.start()
+
+    def poll_forever(self):
+        """
+        Poll until `stop` is called, as a state machine: while CONNECTED we poll; after a failure we wait in
+        BACKOFF (for an exponentially increasing, jittered delay), then either go back to polling or, if the
+        session appears to be dead or we've failed repeatedly, to CONNECTING to start a new session.
+        """
+
+        failures = 0
+
+        while not self._stopping.is_set():
+
+            if self.state == CONNECTING:
+                try:
+                    self.initialize()
+                    self.reconnects += 1
+                    self._set_state(CONNECTED)
+                except Exception as e:
+                    failures += 1
+                    self.errors += 1
+                    logger.error(
+                        "Could not reconnect monitoring session {}: {}".format(
+                            self.index, e
+                        )
+                    )
+                    self._set_state(BACKOFF)
+
+            elif self.state == CONNECTED:
+                try:
+                    self.poll()
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    self.errors += 1
+                    if self._stopping.is_set():
+                        break
+                    logger.warning(
+                        "Problem polling monitoring session {} ({} consecutive failures): {}".format(
+                            self.index, failures, e
+                        )
                     )
+                    self._set_state(BACKOFF)
+
+            elif self.state == BACKOFF:
+                self._stopping.wait(self._backoff_delay(failures))
+                if self._needs_reconnect or failures >= self.reconnect_after_failures:
+                    self._set_state(CONNECTING)
+                else:
+                    self._set_state(CONNECTED)
+
+    def _set_state(self, state):
+        # `stop` may be called from another thread at any point, e.g. during a reconnect, and mustn't be undone
+        if not self._stopping.is_set():
+            self.state = state
+
+    def stop(self, timeout=None):
+        """
+        Stop polling, close the connection, and wait (for up to `timeout` seconds) for the polling thread to exit.
+        """
+        self.state = STOPPED
+        self._stopping.set()
+        self._close_websocket()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def get_stats(self):
+        return {
+            "session": self.index,
+            "state": self.state,
+            "transport": "websocket" if self._websocket is not None else "polling",
+            "subscriptions": len(self._subscriptions),
+            "polls": self.polls,
+            "errors": self.errors,
+            "reconnects": self.reconnects,
+            "last_poll_latency": self.last_poll_latency,
+            "seconds_since_last_poll": (
+                time.time() - self.last_poll_time if self.last_poll_time else None
+            ),
+        }
+
+
+class Monitor(object):
+    """
+    Watches subscribed records for changes, via Notion's Engine.IO-based message store. By default this uses
+    HTTP long-polling; pass `transport="websocket"` (requires the `websocket-client` package) to upgrade to a
+    single persistent websocket connection instead, falling back to polling if the upgrade fails.
+
+    Subscriptions are sharded across multiple sessions, each holding at most `max_subscriptions_per_session`
+    of them, so that large watchlists don't have to be re-registered all at once when a connection drops.
+
+    Set `debounce` to a number of seconds to accumulate change notifications for that long before refreshing
+    the changed records together (in requests of at most `refresh_chunk_size` records, and re-querying each
+    changed collection once), rather than refreshing after every poll.
+    """
+
+    polling = False
+
+    def __init__(
+        self,
+        client,
+        root_url="https://msgstore.www.notion.so/primus/",
+        transport="polling",
+        debounce=0,
+        refresh_chunk_size=100,
+        max_subscriptions_per_session=5000,
+    ):
+        assert transport in ["polling", "websocket"]
+        self.client = client
+        self.root_url = root_url
+        self.transport = transport
+        self.debounce = debounce
+        self.refresh_chunk_size = refresh_chunk_size
+        self.max_subscriptions_per_session = max_subscriptions_per_session
+        self._pending_refresh = defaultdict(dict)
+        self._pending_collections = set()
+        self._pending_lock = threading.Lock()
+        self._flush_timer = None
+        self._stopped = threading.Event()
+        self._sessions_lock = threading.RLock()
+        self._key_sessions = {}
+        self.sessions = []
+        self._add_session()
+
+    def _add_session(self):
+        # starting a session makes a request, so we don't hold the lock while doing so
+        session = MonitorSession(self, index=len(self.sessions))
+        with self._sessions_lock:
+            session.index = len(self.sessions)
+            self.sessions.append(session)
+        if self.polling:
+            session.poll_async()
+        return session
+
+    def subscribe(self, records, recursive=False):
+
+        if isinstance(records, set):
+            records = list(records)
+
+        if not isinstance(records, list):
+            records = [records]
+
+        keys = []
+        seen = set()
+
+        for record in records:
+            self._collect_keys(record._table, record.id, recursive, keys, seen)
+
+        self._subscribe_keys(keys)
+
+    def _collect_keys(self, table, id, recursive, keys, seen):
+        """
+        Add the subscription keys for a record to `keys`, and (if `recursive`) those of its descendants that are
+        in the local store. We only look at locally stored data here, so no requests are made.
+        """
+
+        if (table, id) in seen:
+            return
+        seen.add((table, id))
+
+        store = self.client._store
+
+        # subscribe to changes to the record itself
+        keys.append(self._versions_key(table, id))
+
+        if table == "collection":
+            # subscribe to changes to its set of rows, and to each of the rows we know about
+            keys.append("collection/{}".format(id))
+            for row_id in store.get_collection_rows(id):
+                if recursive:
+                    self._collect_keys("block", row_id, recursive, keys, seen)
+                else:
+                    keys.append(self._versions_key("block", row_id))
+
+        if recursive and table == "block":
+            value = store._get(table, id) or {}
+            for child_id in value.get("content", []):
+                self._collect_keys("block", child_id, recursive, keys, seen)
+            if value.get("collection_id"):
+                self._collect_keys(
+                    "collection", value["collection_id"], recursive, keys, seen
                 )
-                # if we're close to giving up, also try reinitializing the session
-                self.initialize()
-            self.poll(retries=retries - 1)
 
-        self._refresh_updated_records(
-            self._decode_numbered_json_thing(response.content)
-        )
+    def _versions_key(self, table, id):
+        return "versions/{}:{}".format(id, table)
+
+    def _subscribe_keys(self, keys):
+        """
+        Assign any keys we aren't already subscribed to to a session with spare capacity (starting new sessions
+        as needed), and register them with the server. If that fails, the keys that weren't registered are
+        forgotten again, so that a later call will retry them.
+        """
+
+        keys = list(keys)
+
+        while keys:
+            new_keys = defaultdict(list)
+            overflow = []
+
+            with self._sessions_lock:
+                session = self.sessions[-1]
+                for key in keys:
+                    if key in self._key_sessions:
+                        continue
+                    if len(session._subscriptions) >= self.max_subscriptions_per_session:
+                        overflow.append(key)
+                        continue
+                    logger.debug(
+                        "Subscribing to monitoring key {} in session {}".format(
+                            key, session.index
+                        )
+                    )
+                    # add the key to the session's set of subscriptions to restore if it's disconnected
+                    session._subscriptions.add(key)
+                    self._key_sessions[key] = session
+                    new_keys[session].append(key)
+
+            for session, session_keys in new_keys.items():
+                try:
+                    session._send_subscriptions(session_keys)
+                except Exception:
+                    # forget the keys, so that they're subscribed again next time rather than silently unwatched
+                    with self._sessions_lock:
+                        for key in session_keys:
+                            session._subscriptions.discard(key)
+                            if self._key_sessions.get(key) is session:
+                                del self._key_sessions[key]
+                    raise
+
+            if overflow:
+                self._add_session()
+            keys = overflow
+
+    def poll(self):
+        """
+        Poll each of the sessions once, in turn.
+        """
+        for session in list(self.sessions):
+            session.poll()
 
     def _refresh_updated_records(self, events):
 
-        records_to_refresh = defaultdict(list)
+        records_to_refresh = defaultdict(dict)
+        collections_to_refresh = set()
 
         for event in events:
 
@@ -199,7 +638,7 @@ class Monitor(object):
                                 record_table, record_id, local_version, event["value"]
                             )
                         )
-                        records_to_refresh[record_table].append(record_id)
+                        records_to_refresh[record_table][record_id] = event["value"]
                     else:
                         logger.debug(
                             "Record {}/{} already at version {}, not trying to update to version {}".format(
@@ -215,31 +654,127 @@ class Monitor(object):
 
                     collection_id = match.groups()[0]
 
-                    self.client.refresh_collection_rows(collection_id)
-                    row_ids = self.client._store.get_collection_rows(collection_id)
+                    # there's often a burst of these for a single edit, so just note the collection here, and
+                    # re-query it once when the pending refreshes are flushed
+                    collections_to_refresh.add(collection_id)
+
+        self._queue_refresh(records_to_refresh, collections_to_refresh)
+
+    def _queue_refresh(self, records, collection_ids=()):
+        """
+        Add records (a dict mapping tables to dicts of record IDs and their new versions), and collections whose
+        rows may have changed, to the set awaiting refresh. If debouncing is enabled, the refresh happens once the
+        debounce window has passed, so that bursts of changes spread across many polls are refreshed together;
+        otherwise it happens immediately.
+        """
+
+        with self._pending_lock:
+            for table, versions in records.items():
+                pending = self._pending_refresh[table]
+                for record_id, version in versions.items():
+                    pending[record_id] = max(version, pending.get(record_id, -1))
+            self._pending_collections.update(collection_ids)
+            flush_now = self.debounce <= 0
+            if not flush_now and self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.debounce, self._timed_flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+        if flush_now:
+            self.flush()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error("Encountered error while refreshing updated records!")
+            logger.error(e, exc_info=True)
+
+    def flush(self):
+        """
+        Refresh all records with pending change notifications, deduplicated, and in chunks of at most
+        `refresh_chunk_size` records per request, and re-query each collection with pending changes once.
+        """
+
+        with self._pending_lock:
+            pending, self._pending_refresh = self._pending_refresh, defaultdict(dict)
+            collection_ids, self._pending_collections = self._pending_collections, set()
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+        store = self.client._store
+
+        for collection_id in collection_ids:
+            # re-query the collection to see which rows were added or removed; the query response also updates
+            # the stored values of the rows it returns, and edits to existing rows arrive via their own
+            # "versions/" subscriptions
+            old_row_ids = set(store.get_collection_rows(collection_id))
+            self.client.refresh_collection_rows(collection_id)
+            row_ids = store.get_collection_rows(collection_id)
+            added_row_ids = [id for id in row_ids if id not in old_row_ids]
 
-                    logger.debug(
-                        "Something inside collection {} has changed; refreshing all {} rows inside it".format(
-                            collection_id, len(row_ids)
-                        )
-                    )
+            logger.debug(
+                "Something inside collection {} has changed; {} of its {} rows are new".format(
+                    collection_id, len(added_row_ids), len(row_ids)
+                )
+            )
 
-                    records_to_refresh["block"] += row_ids
+            self._subscribe_keys(
+                [self._versions_key("block", id) for id in added_row_ids]
+            )
 
-        self.client.refresh_records(**records_to_refresh)
+        for table, versions in pending.items():
+            # skip any records that have caught up in the meantime (e.g. from a collection query)
+            record_ids = [
+                record_id
+                for record_id, version in versions.items()
+                if version > store.get_current_version(table, record_id)
+            ]
+            for i in range(0, len(record_ids), self.refresh_chunk_size):
+                self.client.refresh_records(
+                    **{table: record_ids[i : i + self.refresh_chunk_size]}
+                )
 
     def poll_async(self):
-        if self.thread:
-            # Already polling async; no need to have two threads
-            return
-        self.thread = threading.Thread(target=self.poll_forever, daemon=True)
-        self.thread.start()
+        """
+        Start polling for changes in the background, with one thread per session.
+        """
+        self.polling = True
+        with self._sessions_lock:
+            for session in self.sessions:
+                session.poll_async()
 
     def poll_forever(self):
-        while True:
-            try:
-                self.poll()
-            except Exception as e:
-                logger.error("Encountered error during polling!")
-                logger.error(e, exc_info=True)
-                time.sleep(1)
+        """
+        Poll in the background, and block until `stop` is called.
+        """
+        self.poll_async()
+        self._stopped.wait()
+
+    def stop(self, timeout=5):
+        """
+        Stop polling on all sessions, and refresh any records with notifications still awaiting a debounced flush.
+        """
+        self.polling = False
+        with self._sessions_lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.stop(timeout=timeout)
+        self.flush()
+        self._stopped.set()
+
+    def get_stats(self):
+        """
+        Return health metrics for the monitor, including per-session poll counts, latency, errors and reconnects.
+        """
+        with self._pending_lock:
+            pending = sum(len(versions) for versions in self._pending_refresh.values())
+            pending += len(self._pending_collections)
+        with self._sessions_lock:
+            sessions = [session.get_stats() for session in self.sessions]
+        return {
+            "polling": self.polling,
+            "pending_refresh": pending,
+            "sessions": sessions,
+        }
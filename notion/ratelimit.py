@@ -0,0 +1,184 @@
+import threading
+import time
+
+from collections import deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+from .logger import logger
+
+
+def parse_retry_after(value):
+    """
+    Parse the value of a "Retry-After" header (either a number of seconds, or an HTTP date) into seconds.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket. A `rate` of None means requests aren't throttled at all until the server
+    tells us to slow down (with a 429), at which point the bucket switches to an adaptive rate that is cut on
+    every 429 and slowly raised again on each successful request (additive increase, multiplicative decrease).
+    """
+
+    # window (in seconds) over which we measure our actual request rate, to pick a starting point when throttled
+    window = 10.0
+
+    def __init__(
+        self, rate=None, burst=None, min_rate=0.5, decrease_factor=0.5, increase_step=0.05
+    ):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self.min_rate = min_rate
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._rate_when_throttled = None
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(
+            float(self.burst), self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def _record_request(self, now):
+        # only keep the timestamps within the measurement window, so the deque doesn't grow without bound
+        self._recent.append(now)
+        while self._recent[0] < now - self.window:
+            self._recent.popleft()
+
+    def _observed_rate(self, now):
+        while self._recent and self._recent[0] < now - self.window:
+            self._recent.popleft()
+        return len(self._recent) / self.window
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        self._record_request(now)
+                        return
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self._record_request(now)
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self, retry_after):
+        """
+        Record that the server rejected a request with a 429, pausing all requests for `retry_after` seconds
+        and reducing the sending rate.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+            current = self.rate or self._observed_rate(now) or 1.0
+            if self._rate_when_throttled is None:
+                self._rate_when_throttled = current
+            self.rate = max(self.min_rate, current * self.decrease_factor)
+            self._tokens = 0.0
+            self._updated = now
+            return self.rate
+
+    def succeeded(self):
+        """
+        Record a successful request, allowing the rate to creep back up towards its configured maximum.
+        """
+        with self._lock:
+            if self._rate_when_throttled is None:
+                return
+            ceiling = self.max_rate or self._rate_when_throttled
+            self._refill(time.monotonic())
+            self.rate += self.increase_step
+            if self.rate >= ceiling:
+                # we've recovered fully, so go back to the configured rate (which may mean unthrottled)
+                self.rate = self.max_rate
+                self._rate_when_throttled = None
+
+
+class RateLimiter(object):
+    """
+    Client-side rate limiting for requests to Notion. Every request acquires a token from the shared "default"
+    bucket, and also from an endpoint-specific bucket if a rate was configured for that endpoint (e.g.
+    `endpoint_rates={"search": 1}`). Rates are in requests per second.
+    """
+
+    def __init__(self, rate=None, burst=None, endpoint_rates=None, max_retries=5, backoff_factor=1.0):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._default = TokenBucket(rate=rate, burst=burst)
+        self._buckets = {
+            endpoint: TokenBucket(rate=endpoint_rate)
+            for endpoint, endpoint_rate in (endpoint_rates or {}).items()
+        }
+
+    def _get_buckets(self, endpoint):
+        if endpoint in self._buckets:
+            return [self._default, self._buckets[endpoint]]
+        return [self._default]
+
+    def acquire(self, endpoint=None):
+        for bucket in self._get_buckets(endpoint):
+            bucket.acquire()
+
+    def throttled(self, endpoint=None, retry_after=None, attempt=0):
+        if retry_after is None:
+            retry_after = self.backoff_factor * (2 ** attempt)
+        for bucket in self._get_buckets(endpoint):
+            rate = bucket.throttled(retry_after)
+        logger.warning(
+            "Rate limited by server on '{}'; pausing for {:.1f}s and slowing to {:.2f} requests/s".format(
+                endpoint, retry_after, rate
+            )
+        )
+
+    def succeeded(self, endpoint=None):
+        for bucket in self._get_buckets(endpoint):
+            bucket.succeeded()
+
+    def request(self, endpoint, send):
+        """
+        Call `send` (which should perform a request and return the response) once a token is available,
+        retrying with backoff (honoring any "Retry-After" header) while the server responds with a 429.
+        """
+        attempt = 0
+        while True:
+            self.acquire(endpoint)
+            response = send()
+            if response.status_code != 429:
+                self.succeeded(endpoint)
+                return response
+            if attempt >= self.max_retries:
+                return response
+            self.throttled(
+                endpoint,
+                retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                attempt=attempt,
+            )
+            attempt += 1
@@ -14,8 +14,6 @@ class Record(object):
         self._client = client
         self._id = extract_id(id)
         self._callbacks = []
-        if self._client._monitor is not None:
-            self._client._monitor.subscribe(self)
 
     @property
     def id(self):
@@ -75,8 +73,17 @@ class Record(object):
             self, callback, callback_id=callback_id, extra_kwargs=extra_kwargs
         )
         self._callbacks.append(callback_obj)
+        # make sure we'll hear about changes to the record, so the callback has a chance to fire
+        self.watch()
         return callback_obj
 
+    def watch(self, recursive=False):
+        """
+        Subscribe to live updates for this record from the server (if monitoring is enabled on the client).
+        See `NotionClient.watch` for details.
+        """
+        self._client.watch(self, recursive=recursive)
+
     def remove_callbacks(self, callback_or_callback_id_prefix=None):
         if callback_or_callback_id_prefix is None:
             for callback_obj in list(self._callbacks):
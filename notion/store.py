@@ -1,9 +1,11 @@
+import asyncio
 import datetime
-import json
+import queue
 import threading
+import time
 import uuid
 
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple
 from copy import deepcopy
 from dictdiffer import diff
 from inspect import signature
@@ -13,7 +15,7 @@ from tzlocal import get_localzone
 
 from .logger import logger
 from .settings import CACHE_DIR
-from .utils import extract_id
+from .utils import extract_id, get_by_path
 
 
 class MissingClass(object):
@@ -24,16 +26,160 @@ class MissingClass(object):
 Missing = MissingClass()
 
 
+class CallbackExecutor(object):
+    """
+    Runs callbacks on a fixed pool of worker threads, rather than a new thread per callback. All callbacks for a
+    given record are routed to the same worker, so they run in the order the changes occurred. Each worker's
+    queue holds at most `max_queue_size` pending callbacks; when it's full, whoever is triggering callbacks
+    blocks until there's room (so a flood of changes applies backpressure instead of piling up threads).
+    The exception is a callback that triggers more callbacks: a worker can't block on a full queue without
+    risking deadlock, so those are held in an overflow list behind the queue, and moved into it in order as
+    room frees up.
+    """
+
+    def __init__(self, workers=4, max_queue_size=1000):
+        self._queues = [queue.Queue(maxsize=max_queue_size) for _ in range(workers)]
+        self._overflows = [deque() for _ in range(workers)]
+        self._threads = []
+        self._worker_idents = set()
+        self._lock = Lock()
+        self._overflow_drained = threading.Condition(self._lock)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+
+    def _start_workers(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(len(self._queues)):
+                thread = threading.Thread(target=self._work, args=(index,), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+                self._worker_idents.add(thread.ident)
+
+    def submit(self, key, func, *args):
+        """
+        Queue `func(*args)` to run on the worker responsible for `key` (e.g. a (table, id) tuple).
+        """
+        self._start_workers()
+        index = hash(key) % len(self._queues)
+        q = self._queues[index]
+        overflow = self._overflows[index]
+        with self._lock:
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth() + 1)
+            if threading.get_ident() in self._worker_idents:
+                # a callback triggered another callback; if the queue is full, blocking could deadlock, so hold
+                # it in the overflow list (behind anything already there, to keep callbacks in order) instead
+                if not overflow:
+                    try:
+                        q.put_nowait((func, args))
+                        return
+                    except queue.Full:
+                        pass
+                overflow.append((func, args))
+                return
+            # don't jump ahead of callbacks waiting in the overflow list
+            while overflow:
+                self._overflow_drained.wait()
+        q.put((func, args))
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logger.debug("Callback {} raised: {}".format(func, repr(e)))
+        finally:
+            with self._lock:
+                self.completed += 1
+
+    def _work(self, index):
+        q = self._queues[index]
+        while True:
+            func, args = q.get()
+            self._run(func, args)
+            # move overflowed callbacks into the queue before marking this one done, so `join` waits for them too
+            self._drain_overflow(index)
+            q.task_done()
+
+    def _drain_overflow(self, index):
+        q = self._queues[index]
+        overflow = self._overflows[index]
+        with self._lock:
+            while overflow:
+                try:
+                    q.put_nowait(overflow[0])
+                except queue.Full:
+                    return
+                overflow.popleft()
+            self._overflow_drained.notify_all()
+
+    def queue_depth(self):
+        return sum(q.qsize() for q in self._queues) + sum(
+            len(overflow) for overflow in self._overflows
+        )
+
+    def join(self):
+        """
+        Block until all queued callbacks have been run.
+        """
+        for q in self._queues:
+            q.join()
+
+    def get_stats(self):
+        return {
+            "workers": len(self._queues),
+            "queue_depth": self.queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
 class Callback(object):
     def __init__(
-        self, callback, record, callback_id=None, extra_kwargs={}, watch_children=True
+        self,
+        callback,
+        record,
+        callback_id=None,
+        extra_kwargs={},
+        watch_children=True,
+        executor=None,
     ):
         self.callback = callback
         self.record = record
         self.callback_id = callback_id or str(uuid.uuid4())
         self.extra_kwargs = extra_kwargs
+        self.executor = executor
+
+        # work out up front which parameters the callback accepts (None means it takes "**kwargs", so all of them)
+        params = signature(self.callback).parameters
+        if any(param.kind == param.VAR_KEYWORD for param in params.values()):
+            self._accepted_params = None
+        else:
+            self._accepted_params = set(params)
 
     def __call__(self, difference, old_val, new_val):
+        if self.executor is None:
+            try:
+                self._run(difference, old_val, new_val)
+            except Exception:
+                pass
+        else:
+            self.executor.submit(
+                (self.record._table, self.record.id),
+                self._run,
+                difference,
+                old_val,
+                new_val,
+            )
+
+    def _run(self, difference, old_val, new_val):
         kwargs = {}
         kwargs.update(self.extra_kwargs)
         kwargs["record"] = self.record
@@ -46,23 +192,21 @@ class Callback(object):
         logger.debug("Firing callback {} with kwargs: {}".format(self.callback, kwargs))
 
         # trim down the parameters we'll be passing, to include only those the callback will accept
-        params = signature(self.callback).parameters
-        if not any(["**" in str(param) for param in params.values()]):
-            # there's no "**kwargs" in the callback signature, so remove any unaccepted params
-            for arg in list(kwargs.keys()):
-                if arg not in params:
-                    del kwargs[arg]
+        if self._accepted_params is not None:
+            kwargs = {
+                arg: val for arg, val in kwargs.items() if arg in self._accepted_params
+            }
 
         # perform the callback, gracefully handling any exceptions
         try:
-            # trigger the callback within its own thread, so it won't block others if it's long-running
-            threading.Thread(target=self.callback, kwargs=kwargs, daemon=True).start()
+            self.callback(**kwargs)
         except Exception as e:
             logger.error(
                 "Error while processing callback for {}: {}".format(
                     repr(self.record), repr(e)
                 )
             )
+            raise
 
     def __eq__(self, val):
         if isinstance(val, str):
@@ -73,15 +217,136 @@ class Callback(object):
             return False
 
 
+# an event in a ChangeFeed; `difference` is the list of changes to the record's value, in dictdiffer's format
+# (the same as passed to callbacks), and `version` is the record's new version
+RecordChange = namedtuple("RecordChange", ["table", "id", "version", "difference"])
+
+
+class ChangeFeed(object):
+    """
+    A consumable stream of RecordChange events, for every change the store applies to a record (whether it came
+    from a refresh, the monitor, or a local operation), optionally restricted to certain `tables`. Events are
+    buffered in a queue of at most `maxsize` events; when it's full, the store blocks until the consumer catches
+    up (backpressure), unless `block` is False, in which case new events are dropped (and counted in `dropped`).
+
+    Iterate over the feed (with `for` or `async for`) to consume events one at a time, or call `get_batch`.
+    Call `close` to detach the feed from the store, which ends any iteration once the queue has drained.
+    """
+
+    # how often (in seconds) a consumer waiting on an empty feed (or the store waiting on a full one) checks
+    # whether it has been closed
+    _close_check_interval = 0.1
+
+    # how often (in seconds) an `async for` consumer waiting on an empty feed checks for new events
+    _async_poll_interval = 0.01
+
+    def __init__(self, store, maxsize=10000, tables=None, block=True):
+        self._store = store
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.tables = set(tables) if tables else None
+        self.block = block
+        self.dropped = 0
+        self.closed = False
+
+    def _publish(self, change):
+        if self.closed or (self.tables and change.table not in self.tables):
+            return
+        if self.block:
+            # wait for the consumer to make room, but give up if the feed is closed meanwhile, so that the thread
+            # updating the store is never left blocked on a feed that nobody will read
+            while not self.closed:
+                try:
+                    self._queue.put(change, timeout=self._close_check_interval)
+                    return
+                except queue.Full:
+                    pass
+            self.dropped += 1
+            return
+        try:
+            self._queue.put_nowait(change)
+        except queue.Full:
+            self.dropped += 1
+
+    def get(self, timeout=None):
+        """
+        Return the next change, waiting for up to `timeout` seconds (forever if None). Returns None on timeout,
+        or if the feed has been closed and drained.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._close_check_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            try:
+                return self._queue.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if self.closed and self._queue.empty():
+                    return None
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+
+    def get_batch(self, max_size=100, timeout=None):
+        """
+        Wait (for up to `timeout` seconds) for at least one change, and return a list of up to `max_size` changes.
+        """
+        first = self.get(timeout=timeout)
+        if first is None:
+            return []
+        batch = [first]
+        while len(batch) < max_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self.closed = True
+        self._store.remove_change_feed(self)
+
+    def __iter__(self):
+        while True:
+            change = self.get()
+            if change is None:
+                return
+            yield change
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # poll from the event loop rather than waiting on the queue in an executor thread, so that if the awaiting
+        # task is cancelled (e.g. by `asyncio.wait_for`), no event has been taken off the queue on its behalf
+        while True:
+            try:
+                return self._queue.get_nowait()
+            except queue.Empty:
+                if self.closed and self._queue.empty():
+                    raise StopAsyncIteration
+            await asyncio.sleep(self._async_poll_interval)
+
+
 class RecordStore(object):
-    def __init__(self, client, cache_key=None):
+    def __init__(
+        self, client, cache_key=None, callback_workers=4, callback_queue_size=1000
+    ):
         self._mutex = Lock()
+        self._callback_executor = CallbackExecutor(
+            workers=callback_workers, max_queue_size=callback_queue_size
+        )
         self._client = client
         self._cache_key = cache_key
         self._values = defaultdict(lambda: defaultdict(dict))
         self._role = defaultdict(lambda: defaultdict(str))
         self._collection_row_ids = {}
+        self._collection_rows_loaded_at = {}
+        self._collection_revisions = defaultdict(int)
         self._callbacks = defaultdict(lambda: defaultdict(list))
+        self._change_feeds = []
+        self._derived = {}
         self._records_to_refresh = {}
         self._pages_to_refresh = []
         with self._mutex:
@@ -90,17 +355,57 @@ class RecordStore(object):
     def _get(self, table, id):
         return self._values[table].get(id, Missing)
 
+    def get_derived(self, table, id, name, build):
+        """
+        Return `build(value)` for the record's current value, reusing the previous result until the record's value
+        is replaced (which happens whenever it's updated from the server or by a local operation). Used to cache
+        data structures derived from a record, such as the lookup tables over a collection's schema, or the decoded
+        values of a collection row's properties.
+        """
+        value = self._get(table, id)
+        if value is Missing:
+            return build(None)
+        derived = self._derived.setdefault((table, id), {})
+        cached = derived.get(name)
+        if cached is not None and cached[0] is value:
+            return cached[1]
+        result = build(value)
+        derived[name] = (value, result)
+        return result
+
     def add_callback(self, record, callback, callback_id=None, extra_kwargs={}):
         assert callable(
             callback
         ), "The callback must be a 'callable' object, such as a function."
         self.remove_callbacks(record._table, record.id, callback_id)
         callback_obj = Callback(
-            callback, record, callback_id=callback_id, extra_kwargs=extra_kwargs
+            callback,
+            record,
+            callback_id=callback_id,
+            extra_kwargs=extra_kwargs,
+            executor=self._callback_executor,
         )
         self._callbacks[record._table][record.id].append(callback_obj)
         return callback_obj
 
+    def change_feed(self, maxsize=10000, tables=None, block=True):
+        """
+        Create and return a ChangeFeed that will receive every subsequent change to records in the store.
+        """
+        feed = ChangeFeed(self, maxsize=maxsize, tables=tables, block=block)
+        self._change_feeds.append(feed)
+        return feed
+
+    def remove_change_feed(self, feed):
+        if feed in self._change_feeds:
+            self._change_feeds.remove(feed)
+
+    def get_callback_stats(self):
+        """
+        Return metrics about the callback executor: queue depth (current and maximum), and callback counts.
+        """
+        return self._callback_executor.get_stats()
+
     def remove_callbacks(self, table, id, callback_or_callback_id_prefix=""):
         """
         Remove all callbacks for the record specified by `table` and `id` that have a callback_id
@@ -122,12 +427,13 @@ class RecordStore(object):
             return
         for attr in attributes:
             try:
-                with open(self._get_cache_path(attr)) as f:
-                    if attr == "_collection_row_ids":
-                        self._collection_row_ids.update(json.load(f))
-                    else:
-                        for k, v in json.load(f).items():
-                            getattr(self, attr)[k].update(v)
+                with open(self._get_cache_path(attr), "rb") as f:
+                    data = self._client.json_codec.loads(f.read())
+                if attr == "_collection_row_ids":
+                    self._collection_row_ids.update(data)
+                else:
+                    for k, v in data.items():
+                        getattr(self, attr)[k].update(v)
             except (FileNotFoundError, ValueError):
                 pass
 
@@ -155,16 +461,33 @@ class RecordStore(object):
                     new_ids,
                 )
         self._collection_row_ids[collection_id] = row_ids
+        self._collection_rows_loaded_at[collection_id] = time.monotonic()
+        self._collection_revisions[collection_id] += 1
         self._save_cache("_collection_row_ids")
 
     def get_collection_rows(self, collection_id):
         return self._collection_row_ids.get(collection_id, [])
 
+    def get_collection_rows_age(self, collection_id):
+        """
+        Return how many seconds ago the collection's list of rows was last set, or None if it hasn't been set
+        since the store was created (even if it was loaded from the cache).
+        """
+        loaded_at = self._collection_rows_loaded_at.get(collection_id)
+        return None if loaded_at is None else time.monotonic() - loaded_at
+
+    def get_collection_revision(self, collection_id):
+        """
+        Return a counter that's incremented whenever the collection's list of rows, or any of its rows, changes.
+        Used to tell when data derived from the rows (such as local query indexes) needs rebuilding.
+        """
+        return self._collection_revisions[collection_id]
+
     def _save_cache(self, attribute):
         if not self._cache_key:
             return
-        with open(self._get_cache_path(attribute), "w") as f:
-            json.dump(getattr(self, attribute), f)
+        with open(self._get_cache_path(attribute), "wb") as f:
+            f.write(self._client.json_codec.dumpb(getattr(self, attribute)))
 
     def _trigger_callbacks(self, table, id, difference, old_val, new_val):
         for callback_obj in self._callbacks[table][id]:
@@ -187,9 +510,20 @@ class RecordStore(object):
             result = self._get(table, id)
         return result if result is not Missing else None
 
+    def get_many(self, table, ids, chunk_size=500):
+        """
+        Return the values of the given records, in order (None for any that can't be found), first loading any that
+        aren't in the local store using as few `getRecordValues` requests as possible.
+        """
+        missing = list(set(id for id in ids if self._get(table, id) is Missing))
+        for i in range(0, len(missing), chunk_size):
+            self.call_get_record_values(**{table: missing[i : i + chunk_size]})
+        return [self._values[table].get(id) for id in ids]
+
     def _update_record(self, table, id, value=None, role=None):
 
         callback_queue = []
+        change_queue = []
 
         with self._mutex:
             if role:
@@ -211,13 +545,24 @@ class RecordStore(object):
                 )
                 self._values[table][id] = value
                 self._save_cache("_values")
+                self._derived.pop((table, id), None)
+                for val in (old_val, value):
+                    if val and val.get("parent_table") == "collection":
+                        self._collection_revisions[val.get("parent_id")] += 1
                 if old_val and difference:
                     logger.debug("Value changed! Difference: {}".format(difference))
                     callback_queue.append((table, id, difference, old_val, value))
+                if difference and self._change_feeds:
+                    change_queue.append(
+                        RecordChange(table, id, value.get("version"), difference)
+                    )
 
-        # run callbacks outside the mutex to avoid lockups
+        # run callbacks (and publish to change feeds, which may block) outside the mutex to avoid lockups
         for cb in callback_queue:
             self._trigger_callbacks(*cb)
+        for change in change_queue:
+            for feed in list(self._change_feeds):
+                feed._publish(change)
 
     def call_get_record_values(self, **kwargs):
         """
@@ -251,9 +596,9 @@ class RecordStore(object):
                     requestlist
                 )
             )
-            results = self._client.post(
+            results = self._client.call_api(
                 "getRecordValues", {"requests": requestlist}
-            ).json()["results"]
+            )["results"]
             for request, result in zip(requestlist, results):
                 self._update_record(
                     request["table"],
@@ -283,9 +628,7 @@ class RecordStore(object):
             "verticalColumns": False,
         }
 
-        recordmap = self._client.post("loadPageChunk", data).json()["recordMap"]
-
-        self.store_recordmap(recordmap)
+        self.store_recordmap_stream(self._client.stream_recordmap("loadPageChunk", data))
 
     def store_recordmap(self, recordmap):
         for table, records in recordmap.items():
@@ -298,6 +641,26 @@ class RecordStore(object):
                     table, id, value=record.get("value"), role=record.get("role")
                 )
 
+    def iter_store_recordmap(self, stream):
+        """
+        Store each record from a RecordMapStream as soon as it has been decoded, yielding its (table, id).
+        """
+        for table, id, record in stream:
+            if not isinstance(record, dict):
+                continue
+            self._update_record(
+                table, id, value=record.get("value"), role=record.get("role")
+            )
+            yield table, id
+
+    def store_recordmap_stream(self, stream):
+        """
+        Store all the records from a RecordMapStream, and return the other top-level data from the response.
+        """
+        for _ in self.iter_store_recordmap(stream):
+            pass
+        return stream.data
+
     def call_query_collection(
         self,
         collection_id,
@@ -306,11 +669,18 @@ class RecordStore(object):
         type="table",
         aggregate=[],
         aggregations=[],
+        filter=[],
         sort=[],
         calendar_by="",
         group_by="",
-        limit=50
+        limit=50,
+        include_rows=True,
     ):
+        """
+        Call the server's queryCollection endpoint. Any aggregations are requested as "aggregation" reducers,
+        and their results returned under "aggregationResults" (in the same order). If `include_rows` is False,
+        the matching rows aren't requested at all, e.g. when only the aggregations are needed.
+        """
 
         assert not (
             aggregate and aggregations
@@ -332,12 +702,7 @@ class RecordStore(object):
                 "spaceId": self._client.current_space.id
             },
             "loader": {
-                'reducers': {
-                    'collection_group_results': {
-                        'limit': limit,
-                        'type': 'results',
-                    },
-                },
+                'reducers': {},
                 "searchQuery": search,
                 'sort': sort,
                 "userTimeZone": str(get_localzone()),
@@ -345,11 +710,51 @@ class RecordStore(object):
             },
         }
 
-        response = self._client.post("queryCollection", data).json()
-
-        self.store_recordmap(response["recordMap"])
+        if filter:
+            # only matching rows are returned, rather than the whole collection
+            data["loader"]["filter"] = filter
+
+        reducers = data["loader"]["reducers"]
+        if include_rows:
+            reducers["collection_group_results"] = {'limit': limit, 'type': 'results'}
+
+        if group_by:
+            # the number of rows in each group; the rows of each group can then be fetched by filtering on its value
+            schema = (self.get("collection", collection_id) or {}).get("schema") or {}
+            reducers["board_columns"] = {
+                "type": "groups",
+                "groupBy": {
+                    "type": schema.get(group_by, {}).get("type"),
+                    "property": group_by,
+                },
+                "groupSortPreference": [],
+            }
+
+        aggregation_reducers = []
+        for i, aggregation in enumerate(aggregate or aggregations):
+            name = "aggregation_{}".format(i)
+            reducer = {
+                # the old format calls the aggregator the "aggregation_type"
+                "aggregator": aggregation.get("aggregator")
+                or aggregation.get("aggregation_type")
+            }
+            if aggregation.get("property"):
+                reducer["property"] = aggregation["property"]
+            reducers[name] = {"type": "aggregation", "aggregation": reducer}
+            aggregation_reducers.append(name)
+
+        response = self.store_recordmap_stream(
+            self._client.stream_recordmap("queryCollection", data)
+        )
 
-        return response["result"]
+        result = response["result"]
+        if aggregation_reducers:
+            reducer_results = result.get("reducerResults", {})
+            result["aggregationResults"] = [
+                reducer_results.get(name, {}).get("aggregationResult", {})
+                for name in aggregation_reducers
+            ]
+        return result
 
     def handle_post_transaction_refreshing(self):
 
@@ -0,0 +1,363 @@
+import sqlite3
+import threading
+
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+from .logger import logger
+from .settings import DATA_DIR
+from .utils import extract_id, now
+
+
+MIRROR_DIR = str(Path(DATA_DIR).joinpath("mirrors"))
+
+# block types whose contents live in their own page chunk, so need to be loaded separately when walking a tree
+PAGE_TYPES = ["page", "collection_view_page"]
+
+
+class LocalMirror(object):
+    """
+    A persistent local copy of Notion records, kept in an SQLite database. Each record is stored as JSON along
+    with its version, so we can tell cheaply whether a record fetched from the server is newer than our copy.
+    Also stores named checkpoints (e.g. the time of the last successful sync).
+    """
+
+    def __init__(self, path, json_codec):
+        self.path = path
+        self.json_codec = json_codec
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "tbl TEXT NOT NULL, id TEXT NOT NULL, version INTEGER NOT NULL, "
+                "last_edited_time INTEGER, value TEXT NOT NULL, PRIMARY KEY (tbl, id))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def get(self, table, id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM records WHERE tbl = ? AND id = ?", (table, id)
+            ).fetchone()
+        return self.json_codec.loads(row[0]) if row else None
+
+    def get_versions(self, table, ids):
+        """
+        Return a dict mapping each of the given record IDs that are in the mirror to its stored version.
+        """
+        versions = {}
+        ids = list(ids)
+        with self._lock:
+            # stay well below SQLite's limit on the number of query parameters
+            for i in range(0, len(ids), 500):
+                chunk = ids[i : i + 500]
+                rows = self._db.execute(
+                    "SELECT id, version FROM records WHERE tbl = ? AND id IN ({})".format(
+                        ",".join("?" * len(chunk))
+                    ),
+                    [table] + chunk,
+                )
+                versions.update(rows)
+        return versions
+
+    def put_many(self, records):
+        """
+        Save a list of (table, id, value) records, skipping any that aren't newer than the version already stored.
+        Returns the number of records written.
+        """
+        by_table = {}
+        for table, id, value in records:
+            by_table.setdefault(table, {})[id] = value
+
+        rows = []
+        for table, values in by_table.items():
+            versions = self.get_versions(table, values.keys())
+            for id, value in values.items():
+                version = value.get("version", 0)
+                if id in versions and versions[id] >= version:
+                    continue
+                rows.append(
+                    (
+                        table,
+                        id,
+                        version,
+                        value.get("last_edited_time"),
+                        self.json_codec.dumps(value),
+                    )
+                )
+
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO records (tbl, id, version, last_edited_time, value) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def count(self, table=None):
+        with self._lock:
+            if table:
+                query = self._db.execute(
+                    "SELECT COUNT(*) FROM records WHERE tbl = ?", (table,)
+                )
+            else:
+                query = self._db.execute("SELECT COUNT(*) FROM records")
+            return query.fetchone()[0]
+
+    def get_checkpoint(self, name):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM checkpoints WHERE name = ?", (name,)
+            ).fetchone()
+        return self.json_codec.loads(row[0]) if row else None
+
+    def set_checkpoint(self, name, value):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO checkpoints (name, value) VALUES (?, ?)",
+                (name, self.json_codec.dumps(value)),
+            )
+
+    def close(self):
+        self._db.close()
+
+
+class SyncEngine(object):
+    """
+    Maintains a local mirror (see `LocalMirror`) of a workspace, or of the tree under a particular page. The first
+    run walks the whole tree; after that, each run records a checkpoint, and the next one only asks the server for
+    pages edited since then (using `search` with a `lastEditedTime` filter), comparing record versions so that only
+    records that actually changed are re-fetched and written.
+
+    Usage:
+
+        engine = SyncEngine(client, root=page_url_or_id)  # or omit `root` to mirror the client's current space
+        stats = engine.run()
+    """
+
+    # how far (in ms) before the previous run's start time to look for edits, to allow for clock skew and
+    # for edits that hadn't yet been indexed by search when the previous run happened
+    checkpoint_overlap = 10 * 60 * 1000
+
+    def __init__(
+        self,
+        client,
+        root=None,
+        path=None,
+        page_chunk_limit=1000,
+        search_limit=1000,
+        batch_size=100,
+    ):
+        self.client = client
+        self.root_id = extract_id(root) if root else None
+        self.space_id = client.current_space.id
+        self.page_chunk_limit = page_chunk_limit
+        self.search_limit = search_limit
+        self.batch_size = batch_size
+        if path is None:
+            Path(MIRROR_DIR).mkdir(parents=True, exist_ok=True)
+            path = str(
+                Path(MIRROR_DIR).joinpath("{}.sqlite3".format(self.root_id or self.space_id))
+            )
+        self.mirror = LocalMirror(path, client.json_codec)
+        self._checkpoint_name = "last_sync:{}".format(self.root_id or self.space_id)
+
+    def run(self, full=False):
+        """
+        Bring the mirror up to date, and return a dict of stats about the run. If `full` is True, or there's no
+        checkpoint from a previous run, the whole tree is walked; otherwise only recently edited pages are checked.
+        """
+
+        started = now()
+        checkpoint = None if full else self.mirror.get_checkpoint(self._checkpoint_name)
+
+        if checkpoint is None:
+            logger.info("Running full sync into {}".format(self.mirror.path))
+            stats = self._sync_tree(self._get_root_page_ids())
+        else:
+            logger.info(
+                "Running incremental sync of edits since {} into {}".format(
+                    checkpoint, self.mirror.path
+                )
+            )
+            stats = self._sync_edited_since(checkpoint - self.checkpoint_overlap)
+
+        self.mirror.set_checkpoint(self._checkpoint_name, started)
+        stats["checkpoint"] = started
+        return stats
+
+    def _get_root_page_ids(self):
+        if self.root_id:
+            return [self.root_id]
+        space = self.client._store.get("space", self.space_id) or {}
+        return space.get("pages", [])
+
+    def _sync_edited_since(self, since):
+
+        edited_since = datetime.fromtimestamp(since / 1000).strftime("%Y-%m-%d")
+        results = self.client.search(
+            limit=self.search_limit,
+            sort="LastEdited",
+            ancestors=[self.root_id] if self.root_id else [],
+            lastEditedTime={
+                "starting": {
+                    "type": "exact",
+                    "value": {"type": "date", "start_date": edited_since},
+                }
+            },
+        )
+
+        if len(results) >= self.search_limit:
+            # search results can't be paginated, so we may have missed some edits; walk the whole tree instead
+            logger.warning(
+                "Search returned {} edited pages (the limit), so running a full sync instead".format(
+                    len(results)
+                )
+            )
+            return self._sync_tree(self._get_root_page_ids())
+
+        # search filters by date only, so narrow down to records that were actually edited since the checkpoint,
+        # and whose version is newer than the one in our mirror
+        edited = {
+            block.id: block.get()
+            for block in results
+            if block and (block.get("last_edited_time") or 0) >= since
+        }
+        versions = self.mirror.get_versions("block", edited.keys())
+        changed = {
+            id: value
+            for id, value in edited.items()
+            if value.get("version", 0) > versions.get(id, -1)
+        }
+
+        stats = {
+            "checked": len(edited),
+            "written": self.mirror.put_many(
+                [("block", id, value) for id, value in changed.items()]
+            ),
+            "pages_loaded": 0,
+        }
+
+        # reload the contents of changed pages, since edits to their child blocks may not show up in search
+        page_ids = [id for id, value in changed.items() if value.get("type") in PAGE_TYPES]
+        tree_stats = self._sync_tree(page_ids, recursive=False)
+        for key in stats:
+            stats[key] += tree_stats[key]
+
+        return stats
+
+    def _sync_tree(self, page_ids, recursive=True):
+        """
+        Load the given pages (and, if `recursive`, all the pages beneath them) into the mirror.
+        """
+
+        stats = {"checked": 0, "written": 0, "pages_loaded": 0}
+        queue = deque(page_ids)
+        seen = set(page_ids)
+        seen_collections = set()
+
+        while queue:
+            page_id = queue.popleft()
+            records = []
+            subpages = []
+            for table, id in self._iter_page_records(page_id, seen_collections):
+                # records we don't have permission to read come back without a value, so aren't in the store
+                value = self.client._store._get(table, id)
+                if not value:
+                    continue
+                records.append((table, id, value))
+                if recursive and id not in seen and self._should_walk(table, value):
+                    subpages.append((id, value))
+                if len(records) >= self.batch_size:
+                    stats["written"] += self.mirror.put_many(records)
+                    stats["checked"] += len(records)
+                    records = []
+            stats["written"] += self.mirror.put_many(records)
+            stats["checked"] += len(records)
+            stats["pages_loaded"] += 1
+
+            # the page chunk also includes records from outside the page (e.g. its ancestors), which mustn't be
+            # walked, so only queue pages that are inside this one (now that all of its records are loaded)
+            for id, value in subpages:
+                if id not in seen and self._is_inside(page_id, value):
+                    seen.add(id)
+                    queue.append(id)
+
+        return stats
+
+    def _should_walk(self, table, value):
+        # collection rows are pages too, so their contents need loading separately
+        return table == "block" and (
+            value.get("type") in PAGE_TYPES or value.get("parent_table") == "collection"
+        )
+
+    def _is_inside(self, page_id, value):
+        """
+        Check whether a record is part of the given page's contents (rather than e.g. one of its ancestors, or part
+        of another page), by following its parents (through any collections) up to the nearest page.
+        """
+        store = self.client._store
+        visited = set()
+        while True:
+            parent_id = value.get("parent_id")
+            parent_table = value.get("parent_table")
+            if parent_id == page_id:
+                return True
+            if parent_table not in ["block", "collection"] or parent_id in visited:
+                return False
+            visited.add(parent_id)
+            value = store._get(parent_table, parent_id)
+            if not value or (parent_table == "block" and value.get("type") in PAGE_TYPES):
+                return False
+
+    def _iter_page_records(self, page_id, seen_collections):
+        """
+        Load all the chunks of a page (following the cursor returned with each), and then the rows of any
+        collections on it that aren't in `seen_collections` (which is updated), yielding the (table, id) of each
+        record as it's stored.
+        """
+
+        collection_ids = []
+        cursor = {"stack": []}
+        chunk_number = 0
+
+        while True:
+            stream = self.client.stream_recordmap(
+                "loadPageChunk",
+                {
+                    "pageId": page_id,
+                    "limit": self.page_chunk_limit,
+                    "cursor": cursor,
+                    "chunkNumber": chunk_number,
+                    "verticalColumns": False,
+                },
+            )
+            for table, id in self.client._store.iter_store_recordmap(stream):
+                if table == "collection":
+                    collection_ids.append(id)
+                yield table, id
+            cursor = stream.data.get("cursor") or {}
+            if not cursor.get("stack"):
+                break
+            chunk_number += 1
+
+        for collection_id in collection_ids:
+            # the chunks of a collection row's page include its collection too, which we only want to load once
+            value = self.client._store._get("collection", collection_id)
+            if (
+                not value
+                or collection_id in seen_collections
+                or not self._is_inside(page_id, value)
+            ):
+                continue
+            seen_collections.add(collection_id)
+            collection = self.client.get_collection(collection_id)
+            if collection is None:
+                continue
+            for row_id in collection.get_rows(limit=-1)._block_ids:
+                yield "block", row_id
+            yield "collection", collection_id